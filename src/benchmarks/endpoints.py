@@ -0,0 +1,196 @@
+"""End to end benchmark of the API's hot paths
+
+Drives create_stable_diffusion, create_real_ersgan, create_gfpgan, upload_file and list_files through the
+FastAPI app at several concurrency levels, and reports throughput, p50/p95/p99 latency and peak RSS (per case on Linux).
+By default the models are replaced with deterministic CPU stubs (see benchmarks/stubs.py) so that the
+request handling around them is what gets measured; pass --real to use the real weights on the GPU.
+
+Results can be compared against a stored baseline, exiting with status 1 on a regression:
+
+    python -m benchmarks.endpoints --update-baseline   # on the base branch
+    python -m benchmarks.endpoints                     # on the PR
+"""
+import argparse
+import io
+import json
+import os
+import resource
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_BASELINE = os.path.join(BENCHMARKS_DIR, 'baseline_stub.json')
+
+PERCENTILES = [50, 95, 99]
+
+def png_bytes(width: int, height: int):
+  from benchmarks.stubs import seeded_image
+
+  buffer = io.BytesIO()
+  seeded_image('upload', width, height).save(buffer, format='PNG')
+  return buffer.getvalue()
+
+def build_cases(client, input_image: str, output_dir: str, image_size: int, steps: int):
+  """Map of case name to a function issuing one request of that case and returning the response
+
+  Every request of a case has distinct params (each transform writes its own outfile), as identical concurrent
+  requests would be coalesced into one and the benchmark would only measure waiting on it
+  """
+  output = lambda name, i: os.path.join(output_dir, 'benchmark_{}_{}.png'.format(name, i))
+  upload = png_bytes(image_size, image_size)
+  return {
+    "upload_file": lambda i: client.post(
+      "/api/files/upload", files={"file": ("benchmark_{}.png".format(i), upload, "image/png")}),
+    "list_files": lambda i: client.get("/api/files"),
+    "create_stable_diffusion": lambda i: client.post("/api/transforms/stable-diffusion", params={
+      "prompt": "benchmark prompt {}".format(i), "num_inference_steps": steps, "seed": i}),
+    "create_real_ersgan": lambda i: client.post("/api/transforms/real-ersgan", params={
+      "input_image": input_image, "scale": 2, "outfile": output('upscale', i)}),
+    "create_gfpgan": lambda i: client.post("/api/transforms/gfpgan", params={
+      "input_image": input_image, "scale": 1, "outfile": output('face', i)}),
+  }
+
+def reset_peak_rss():
+  """Resets the peak RSS of the process where the OS allows it (Linux), returning whether it did"""
+  try:
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+      clear_refs.write('5')
+    return True
+  except OSError:
+    return False
+
+def peak_rss_mb():
+  """Peak RSS in MB, since the last reset_peak_rss on Linux and over the whole process otherwise"""
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) / 1024
+  except OSError:
+    pass
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_case(request, concurrency: int, count: int):
+  """Runs count requests of a case, concurrency at a time. Peak RSS is reported as "peak_rss_mb" when it could be
+  measured for the case alone, and as "process_peak_rss_mb" (including every earlier case) otherwise"""
+  latencies = []
+  per_case_rss = reset_peak_rss()
+
+  def timed_request(i):
+    start = time.perf_counter()
+    response = request(i)
+    response.raise_for_status()
+    latencies.append(time.perf_counter() - start)
+    return response.json()
+
+  start = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=concurrency) as executor:
+    results = list(executor.map(timed_request, range(count)))
+  wall = time.perf_counter() - start
+
+  stats = {
+    "throughput": count / wall,
+    "peak_rss_mb" if per_case_rss else "process_peak_rss_mb": peak_rss_mb(),
+  }
+  for percentile, value in zip(PERCENTILES, numpy.percentile(latencies, PERCENTILES)):
+    stats["p{}".format(percentile)] = float(value)
+  return stats, results
+
+def compare(results: dict, baseline: dict, tolerance: float):
+  """List of regressions: p95 latency or throughput worse than the baseline by more than tolerance"""
+  regressions = []
+  for case, by_concurrency in results.items():
+    for concurrency, stats in by_concurrency.items():
+      base = baseline.get(case, {}).get(concurrency)
+      if base is None:
+        continue
+      if stats["p95"] > base["p95"] * (1 + tolerance):
+        regressions.append("{} @{}: p95 {:.4f}s vs {:.4f}s".format(case, concurrency, stats["p95"], base["p95"]))
+      if stats["throughput"] < base["throughput"] * (1 - tolerance):
+        regressions.append("{} @{}: throughput {:.2f}/s vs {:.2f}/s".format(
+          case, concurrency, stats["throughput"], base["throughput"]))
+  return regressions
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark the API's hot paths")
+  parser.add_argument('--real', action='store_true', default=False, help='Use the real models instead of stubs')
+  parser.add_argument('--cases', nargs='+', help='Only run these cases')
+  parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 8])
+  parser.add_argument('--requests', type=int, default=32, help='Requests per case and concurrency level')
+  parser.add_argument('--image-size', type=int, default=256, help='Size of the uploaded image the transforms run on')
+  parser.add_argument('--steps', type=int, default=20, help='Inference steps for Stable Diffusion with --real')
+  parser.add_argument('--baseline', type=str, help='Baseline to compare against, defaults to benchmarks/baseline_stub.json for stubs')
+  parser.add_argument('--update-baseline', action='store_true', default=False, help='Write the results as the new baseline')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown before flagging a regression')
+  parser.add_argument('--json', type=str, help='Also write the results to this file')
+  args = parser.parse_args()
+
+  if not args.real:
+    # keep the stub runs away from the real database, caches and images, even when CACHE_DIR is set (e.g. by docker-compose)
+    os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='painter-benchmark-')
+    os.environ['ROOT_DIR'] = os.environ['CACHE_DIR']
+  baseline_path = args.baseline or (None if args.real else DEFAULT_BASELINE)
+
+  from fastapi.testclient import TestClient
+
+  from utils.file_utils import OUTPUT_DIR, ROOT_DIR, UPLOAD_DIR
+  from web.app import create_app
+  if not args.real:
+    from benchmarks import stubs
+    stubs.install()
+
+  for directory in [OUTPUT_DIR, UPLOAD_DIR]:
+    os.makedirs(directory, exist_ok=True)
+  client = TestClient(create_app(serve_files=False))
+  created = []
+  try:
+    input_image = client.post(
+      "/api/files/upload",
+      files={"file": ("benchmark_input.png", png_bytes(args.image_size, args.image_size), "image/png")}).json()["src"]
+    created.append(input_image)
+    cases = build_cases(client, ROOT_DIR + input_image, OUTPUT_DIR, args.image_size, args.steps)
+
+    results = {}
+    for case, request in cases.items():
+      if args.cases is not None and case not in args.cases:
+        continue
+      results[case] = {}
+      for concurrency in args.concurrency:
+        stats, responses = run_case(request, concurrency, args.requests)
+        created.extend(response["src"] for response in responses if isinstance(response, dict) and "src" in response)
+        results[case][str(concurrency)] = stats
+        rss = "rss {:.0f}MB".format(stats["peak_rss_mb"]) if "peak_rss_mb" in stats else \
+          "process rss {:.0f}MB".format(stats["process_peak_rss_mb"])
+        print("{:<24} c={:<3} {:>8.2f} req/s  p50 {:.4f}s  p95 {:.4f}s  p99 {:.4f}s  {}".format(
+          case, concurrency, stats["throughput"], stats["p50"], stats["p95"], stats["p99"], rss))
+  finally:
+    for src in created:
+      if os.path.exists(ROOT_DIR + src):
+        os.remove(ROOT_DIR + src)
+
+  if args.json is not None:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
+
+  if baseline_path is None:
+    return
+  if args.update_baseline:
+    with open(baseline_path, 'w') as out:
+      json.dump(results, out, indent=2)
+    print("Wrote baseline to", baseline_path)
+    return
+  if not os.path.exists(baseline_path):
+    print("No baseline at", baseline_path, "- run with --update-baseline to create one")
+    return
+  with open(baseline_path) as baseline_file:
+    regressions = compare(results, json.load(baseline_file), args.tolerance)
+  for regression in regressions:
+    print("REGRESSION", regression)
+  if regressions:
+    exit(1)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,138 @@
+"""Latency benchmark of prompt history autocomplete and search
+
+Fills a temporary database with a synthetic history (half one-off prompts, half favourites reused following a
+Zipf distribution, with Zipf distributed words), then times autocomplete_prompts and search_prompts for prefixes
+and word combinations of every length. Exits with status 1 if the p95 latency of any kind of query is over --target-ms.
+
+Run from the src directory:
+
+    python -m benchmarks.prompt_history --rows 1000000
+"""
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import numpy
+
+SUBJECTS = [
+  'astronaut', 'horse', 'lighthouse', 'castle', 'dragon', 'robot', 'cat', 'fox', 'forest', 'city', 'ship', 'mountain',
+  'portrait', 'garden', 'temple', 'waterfall', 'owl', 'knight', 'wizard', 'car', 'train', 'island', 'desert', 'tiger',
+]
+MODIFIERS = [
+  'red', 'ancient', 'futuristic', 'tiny', 'giant', 'glowing', 'abandoned', 'floating', 'golden', 'frozen', 'misty',
+  'cyberpunk', 'steampunk', 'cozy', 'dark', 'colorful', 'old', 'mechanical', 'crystal', 'burning',
+]
+STYLES = [
+  'oil painting', 'watercolor', 'studio lighting', 'trending on artstation', 'unreal engine', 'photograph',
+  'by greg rutkowski', 'pixel art', 'concept art', 'highly detailed', '4k', 'octane render', 'matte painting',
+]
+SYLLABLES = ['ka', 'ro', 'mi', 'len', 'tha', 'vor', 'qui', 'sel', 'dun', 'ba', 'zor', 'pi', 'el', 'mar', 'nis', 'tu']
+# Words besides the ones above, real prompts have a long tail of less common words
+RARE_WORDS = 4000
+
+def vocabulary(random: numpy.random.RandomState):
+  """Words prompts are made of, most common first"""
+  rare = set()
+  while len(rare) < RARE_WORDS:
+    rare.add(''.join(random.choice(SYLLABLES, random.randint(2, 5))))
+  return SUBJECTS + MODIFIERS + sorted(rare)
+
+def pick_words(random: numpy.random.RandomState, words: list, count: int):
+  """Words following a Zipf distribution, as word frequencies in text do"""
+  return [words[min(rank, len(words)) - 1] for rank in random.zipf(1.2, size=count)]
+
+def random_prompt(random: numpy.random.RandomState, words: list):
+  subject, modifier, place, place_modifier = pick_words(random, words, 4)
+  text = 'a {} {}'.format(modifier, subject)
+  if random.rand() < 0.5:
+    text += ' riding a ' + ' '.join(pick_words(random, words, 1))
+  text += ' in a {} {}'.format(place_modifier, place)
+  styles = random.choice(STYLES, size=random.randint(1, 4), replace=False)
+  # a serial keeps most prompts distinct, as real prompts mostly are
+  return '{}, {}, seed {}'.format(text, ', '.join(styles), random.randint(10 ** 6))
+
+def fill_history(db_path: str, rows: int, words: list, seed: int):
+  random = numpy.random.RandomState(seed)
+  distinct = [random_prompt(random, words) for _ in range(max(1, rows // 2))]
+  # half of the uses are one-off prompts, the other half keep going back to favourites
+  favourites = numpy.minimum(random.zipf(1.3, size=rows), len(distinct)) - 1
+  uses = numpy.where(random.rand(rows) < 0.5, numpy.arange(rows) % len(distinct), favourites)
+  with sqlite3.connect(db_path) as cur:
+    cur.executemany(
+      "INSERT INTO history (prompt, reference_image) VALUES (?, -1)",
+      ((distinct[index],) for index in uses))
+
+def queries(words: list, seed: int):
+  """Query text by kind of query, with words as frequent in queries as in prompts"""
+  random = numpy.random.RandomState(seed)
+  pick = lambda count: pick_words(random, words, count)
+  return {
+    "autocomplete_short_prefix": [word[:2] for word in pick(50)],
+    "autocomplete_long_prefix": [word[:6] for word in pick(50)],
+    "autocomplete_two_words": ['{} {}'.format(first, second[:4]) for first, second in zip(pick(50), pick(50))],
+    "search_one_word": pick(50),
+    "search_two_words": [' '.join(pick(2)) for _ in range(50)],
+    "search_three_words": [' '.join(pick(3)) for _ in range(50)],
+  }
+
+def run(cases: dict, repeat: int):
+  from utils.db import autocomplete_prompts, search_prompts
+
+  results = []
+  for kind, texts in cases.items():
+    query = autocomplete_prompts if kind.startswith('autocomplete') else search_prompts
+    latencies = []
+    for _ in range(repeat):
+      for text in texts:
+        start = time.perf_counter()
+        query(text)
+        latencies.append((time.perf_counter() - start) * 1000)
+    results.append({
+      "kind": kind,
+      "p50": float(numpy.percentile(latencies, 50)),
+      "p95": float(numpy.percentile(latencies, 95)),
+      "max": float(numpy.max(latencies)),
+    })
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark prompt history autocomplete and search latency")
+  parser.add_argument('--rows', type=int, default=1000000, help='Number of history rows (uses of prompts)')
+  parser.add_argument('--repeat', type=int, default=5)
+  parser.add_argument('--seed', type=int, default=42)
+  parser.add_argument('--target-ms', type=float, default=10.0, help='Maximum p95 latency of every kind of query')
+  parser.add_argument('--json', type=str, help='Also write the results to this file')
+  args = parser.parse_args()
+
+  # the database lives under CACHE_DIR, which has to be set before utils.db is imported
+  os.environ['CACHE_DIR'] = tempfile.mkdtemp(prefix='painter-benchmark-')
+  from utils import db
+
+  words = vocabulary(numpy.random.RandomState(args.seed))
+  db.init_db()
+  start = time.perf_counter()
+  fill_history(db.DB_PATH, args.rows, words, args.seed)
+  # indexes the history into the prompts table, as when upgrading from before it existed
+  db.init_db()
+  with sqlite3.connect(db.DB_PATH) as cur:
+    distinct = cur.execute("SELECT count(*) FROM prompts").fetchone()[0]
+  print('Indexed {} history rows ({} distinct prompts) in {:.1f}s'.format(args.rows, distinct, time.perf_counter() - start))
+
+  results = run(queries(words, args.seed), args.repeat)
+  print('{:<28} {:>10} {:>10} {:>10}'.format('query', 'p50 (ms)', 'p95 (ms)', 'max (ms)'))
+  for result in results:
+    print('{kind:<28} {p50:>10.2f} {p95:>10.2f} {max:>10.2f}'.format(**result))
+  if args.json is not None:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
+
+  slow = [result["kind"] for result in results if result["p95"] > args.target_ms]
+  if slow:
+    print('Over the {}ms p95 target: {}'.format(args.target_ms, ', '.join(slow)))
+    exit(1)
+
+if __name__ == "__main__":
+  main()
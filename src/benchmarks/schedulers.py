@@ -0,0 +1,93 @@
+"""Latency vs. quality benchmark for the Stable Diffusion samplers
+
+Every sampler/step count combination is run on the same prompts and seeds, and compared to the
+default scheduler at 50 steps. The perceptual difference reported is 1 - SSIM, averaged over prompts,
+so 0 means identical to the reference.
+
+Run from the src directory:
+
+    python -m benchmarks.schedulers --schedulers pndm ddim lms --steps 10 15 20 30
+"""
+import argparse
+import json
+import time
+
+import numpy
+import torch
+from skimage.metrics import structural_similarity
+
+from transforms.stable_diffusion import stable_diffusion
+from utils.schedulers import DEFAULT_SCHEDULER, SCHEDULERS
+
+REFERENCE_STEPS = 50
+
+DEFAULT_PROMPTS = [
+  'a photograph of an astronaut riding a horse',
+  'an oil painting of a lighthouse on a cliff at sunset',
+  'portrait of an old man with a beard, studio lighting',
+]
+
+def timed_generation(prompt: str, seed: int, scheduler: str, steps: int):
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+  start = time.perf_counter()
+  img = stable_diffusion(prompt, num_inference_steps=steps, seed=seed, scheduler=scheduler)
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+  return img, time.perf_counter() - start
+
+def perceptual_difference(img, reference):
+  return 1 - structural_similarity(numpy.array(img), numpy.array(reference), channel_axis=2)
+
+def run(prompts, schedulers, steps, seed: int):
+  references = []
+  reference_latency = []
+  for prompt in prompts:
+    img, latency = timed_generation(prompt, seed, DEFAULT_SCHEDULER, REFERENCE_STEPS)
+    references.append(img)
+    reference_latency.append(latency)
+  results = [{
+    "scheduler": DEFAULT_SCHEDULER,
+    "steps": REFERENCE_STEPS,
+    "latency": float(numpy.mean(reference_latency)),
+    "difference": 0.0,
+  }]
+
+  for scheduler in schedulers:
+    for step_count in steps:
+      latencies = []
+      differences = []
+      for prompt, reference in zip(prompts, references):
+        img, latency = timed_generation(prompt, seed, scheduler, step_count)
+        latencies.append(latency)
+        differences.append(perceptual_difference(img, reference))
+      results.append({
+        "scheduler": scheduler,
+        "steps": step_count,
+        "latency": float(numpy.mean(latencies)),
+        "difference": float(numpy.mean(differences)),
+      })
+  return results
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark Stable Diffusion samplers against the default 50 step output")
+  parser.add_argument('--schedulers', nargs='+', choices=list(SCHEDULERS.keys()), default=list(SCHEDULERS.keys()))
+  parser.add_argument('--steps', nargs='+', type=int, default=[10, 15, 20, 25, 30, 50])
+  parser.add_argument('--prompts', nargs='+', default=DEFAULT_PROMPTS)
+  parser.add_argument('--seed', type=int, default=42)
+  parser.add_argument('--json', type=str, help='Also write the results to this file')
+  args = parser.parse_args()
+
+  # warm up so that model loading is not counted against the first run
+  stable_diffusion(args.prompts[0], num_inference_steps=1, seed=args.seed)
+
+  results = run(args.prompts, args.schedulers, args.steps, args.seed)
+  print('{:<10} {:>6} {:>12} {:>12}'.format('scheduler', 'steps', 'latency (s)', '1 - SSIM'))
+  for result in results:
+    print('{scheduler:<10} {steps:>6} {latency:>12.2f} {difference:>12.4f}'.format(**result))
+  if args.json is not None:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
+
+if __name__ == "__main__":
+  main()
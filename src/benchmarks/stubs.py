@@ -0,0 +1,37 @@
+"""Deterministic, CPU only stand-ins for the models, so the request paths around them can be benchmarked quickly"""
+import hashlib
+
+import cv2
+import numpy
+from PIL import Image
+
+def seeded_image(key: str, width: int, height: int):
+  """Noise image that only depends on key and size"""
+  seed = int(hashlib.sha1(key.encode()).hexdigest()[:8], 16)
+  pixels = numpy.random.RandomState(seed).randint(0, 256, (height, width, 3), dtype=numpy.uint8)
+  return Image.fromarray(pixels)
+
+def stub_stable_diffusion(prompt: str, width: int = 512, height: int = 512, seed=None, **kwargs):
+  return seeded_image('{}:{}'.format(prompt, seed), width, height)
+
+class StubUpsampler():
+  """Matches RealESRGANer.enhance, upscaling with bicubic interpolation"""
+
+  def enhance(self, img, outscale=4):
+    height, width = img.shape[0:2]
+    return cv2.resize(img, (int(width * outscale), int(height * outscale)), interpolation=cv2.INTER_CUBIC), None
+
+class StubRestorer():
+  """Matches GFPGANer.enhance, finding no faces and only upscaling the background"""
+
+  def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, upscale=1.0, bg_upsampler=None):
+    restored_img, _ = StubUpsampler().enhance(img, outscale=upscale)
+    return [], [], restored_img
+
+def install():
+  """Replaces every model lookup with its stub"""
+  from transforms import gfpgan, real_ersgan, stable_diffusion
+
+  stable_diffusion.stable_diffusion = stub_stable_diffusion
+  real_ersgan.get_upsampler = lambda *args, **kwargs: StubUpsampler()
+  gfpgan.get_restorer = lambda *args, **kwargs: StubRestorer()
@@ -0,0 +1,106 @@
+"""Latency and memory benchmark of scale-aware Real-ESRGAN upscaling
+
+Every scale is upscaled both the old way, a single pass of the x4 model resized to the requested scale,
+and the current way (see transforms.real_ersgan.upscale_passes), on the same input image. Peak device
+memory is only reported when running on a GPU. The difference reported is 1 - SSIM of the current output
+against the old one, so 0 means identical.
+
+Run from the src directory:
+
+    python -m benchmarks.upscale --scales 1.5 2 3 4 8 --size 512
+"""
+import argparse
+import json
+import time
+
+import cv2
+import numpy
+import torch
+from skimage.metrics import structural_similarity
+
+from benchmarks.stubs import seeded_image
+from transforms.real_ersgan import get_upsampler, upscale_cv_image, upscale_passes
+from utils.images import load_cv_image, pil2opencv
+
+def measured(upscale):
+  """Runs upscale(), returning its output, latency and peak device memory in MB (None on CPU)"""
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+  start = time.perf_counter()
+  output = upscale()
+  peak_memory = None
+  if torch.cuda.is_available():
+    torch.cuda.synchronize()
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20
+  return output, time.perf_counter() - start, peak_memory
+
+def old_upscale(img, scale: float, for_anime: bool):
+  output, _ = get_upsampler(for_anime, 4).enhance(img, outscale = scale)
+  return output
+
+def perceptual_difference(img, reference):
+  return 1 - structural_similarity(img, reference, channel_axis=2)
+
+def run(img, scales, for_anime: bool, repeat: int):
+  results = []
+  for scale in scales:
+    old_latencies, new_latencies = [], []
+    for _ in range(repeat):
+      old_output, old_latency, old_memory = measured(lambda: old_upscale(img, scale, for_anime))
+      new_output, new_latency, new_memory = measured(lambda: upscale_cv_image(img, scale, for_anime))
+      old_latencies.append(old_latency)
+      new_latencies.append(new_latency)
+    if new_output.shape != old_output.shape:
+      new_output = cv2.resize(new_output, old_output.shape[1::-1], interpolation=cv2.INTER_LANCZOS4)
+    results.append({
+      "scale": scale,
+      "passes": [model for model, _ in upscale_passes(for_anime, scale)],
+      "old_latency": float(numpy.mean(old_latencies)),
+      "new_latency": float(numpy.mean(new_latencies)),
+      "old_memory": old_memory,
+      "new_memory": new_memory,
+      "difference": float(perceptual_difference(new_output, old_output)),
+    })
+  return results
+
+def format_memory(memory):
+  return '{:>10.0f}'.format(memory) if memory is not None else '{:>10}'.format('-')
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark scale-aware Real-ESRGAN against always upscaling x4 then resizing")
+  parser.add_argument('--scales', nargs='+', type=float, default=[1.5, 2, 3, 4, 6, 8])
+  parser.add_argument('--input', type=str, help='Image to upscale, defaults to a noise image of --size')
+  parser.add_argument('--size', type=int, default=512)
+  parser.add_argument('--anime', action='store_true', help='Benchmark the anime model instead')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--json', type=str, help='Also write the results to this file')
+  args = parser.parse_args()
+
+  if args.input is not None:
+    img = numpy.array(load_cv_image(args.input))
+  else:
+    img = pil2opencv(seeded_image('upscale', args.size, args.size))
+
+  # warm up so that model loading is not counted against the first run
+  for scale in [2, 4]:
+    upscale_cv_image(img[:64, :64], scale, args.anime)
+
+  results = run(img, args.scales, args.anime, args.repeat)
+  print('{:>6} {:>8} {:>10} {:>10} {:>10} {:>10} {:>10}'.format(
+    'scale', 'passes', 'old (s)', 'new (s)', 'old (MB)', 'new (MB)', '1 - SSIM'))
+  for result in results:
+    print('{:>6} {:>8} {:>10.2f} {:>10.2f} {} {} {:>10.4f}'.format(
+      result["scale"],
+      '+'.join('x{}'.format(model) for model in result["passes"]),
+      result["old_latency"],
+      result["new_latency"],
+      format_memory(result["old_memory"]),
+      format_memory(result["new_memory"]),
+      result["difference"]))
+  if args.json is not None:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
+
+if __name__ == "__main__":
+  main()
@@ -1,16 +1,24 @@
 import argparse
+import logging
 
 from transforms.gfpgan import create_gfpgan
 from transforms.real_ersgan import create_real_ersgan
-from transforms.stable_diffusion import create_stable_diffusion
+from transforms.stable_diffusion import create_refinement, create_stable_diffusion
 from utils.db import init_db
 from utils.file_utils import get_png_filename
+from utils.schedulers import DEFAULT_SCHEDULER, SCHEDULER_NAMES
 
 STABLE_DIFFUSION_ALIASES = ['stable-diffusion', 'generate', 'sd']
 REAL_ESRGAN_ALIASES = ['real-esrgan', 'upscale', 're']
 GFPGAN_ALIASES = ['gfpgan', 'fix-faces', 'gfp']
+REFINE_ALIASES = ['refine']
+
+# Generation settings used when not given, refinements keep those of the checkpoint instead
+DEFAULT_INFERENCE_STEPS = 50
+DEFAULT_GUIDANCE = 7.5
 
 def main():
+    logging.basicConfig(level=logging.INFO)
     init_db()
     parser = argparse.ArgumentParser(
         description="Simple CLI for GPU Image Generation")
@@ -33,13 +41,18 @@ def main():
         '--size',
         type=str,
         default='512x512',
-        help='dimensions of generated image (512x512 is going to be the best by a long shot'
+        help='dimensions of generated image (512x512 is going to be the best by a long shot). Larger sizes use sliced attention and tiled decoding as needed to fit in device memory'
     )
     parser.add_argument(
         '--inference-steps',
         type=int,
-        default=50,
-        help='Number of inference steps before completion - smaller numbers will be less realist, but faster'
+        help='Number of inference steps before completion - smaller numbers will be less realist, but faster. Defaults to 50, or to the checkpoint\'s own schedule when refining'
+    )
+    parser.add_argument(
+        "--scheduler",
+        choices=SCHEDULER_NAMES,
+        default=DEFAULT_SCHEDULER,
+        help='Sampler used for denoising. Some samplers give good results with far fewer inference steps, see benchmarks/schedulers.py'
     )
     parser.add_argument(
         "--strength",
@@ -51,8 +64,29 @@ def main():
         "-g",
         "--guidance",
         type=float,
-        default=7.5,
-        help="Higher guidance scale encourages to generate images that are closely linked to the text prompt, usually at the expense of lower image quality. See https://arxiv.org/pdf/2205.11487.pdf"
+        help="Higher guidance scale encourages to generate images that are closely linked to the text prompt, usually at the expense of lower image quality. Defaults to 7.5, or to the checkpoint's own guidance when refining. See https://arxiv.org/pdf/2205.11487.pdf"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        help="Seed for the initial noise, random if not set"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        action='store_true',
+        default=False,
+        help='Keep the intermediate latents of the generation so that it can be refined later'
+    )
+    parser.add_argument(
+        "--region-inpaint",
+        action='store_true',
+        default=False,
+        help='When inpainting, only diffuse the area around the mask and paste it back into the full resolution image'
+    )
+    parser.add_argument(
+        "--from-step",
+        type=int,
+        help='For refining, the denoising step to resume from (defaults to the last intermediate step saved)'
     )
     parser.add_argument(
         "--scale",
@@ -85,8 +119,8 @@ def main():
     parser.add_argument(
         'tool', 
         nargs=1, 
-        choices=STABLE_DIFFUSION_ALIASES + REAL_ESRGAN_ALIASES + GFPGAN_ALIASES,
-        help="Tool used. stable-diffusion/generate will generate an image from text, real-esrgan/upscale will upscale an image, and gfpgan/fix-faces will restore faces ")
+        choices=STABLE_DIFFUSION_ALIASES + REAL_ESRGAN_ALIASES + GFPGAN_ALIASES + REFINE_ALIASES,
+        help="Tool used. stable-diffusion/generate will generate an image from text, real-esrgan/upscale will upscale an image, gfpgan/fix-faces will restore faces and refine will continue a checkpointed generation")
 
     parser.add_argument('prompt',
                     nargs='+',
@@ -101,17 +135,39 @@ def main():
     outfile = None
     if args.tool[0] in STABLE_DIFFUSION_ALIASES:
         print('Stably diffusing')
-        create_stable_diffusion(
+        res = create_stable_diffusion(
             prompt=' '.join(args.prompt),
             outfile=args.out,
             img_prompt=args.img,
             img_mask=args.mask,
             width=width,
             height=height,
+            num_inference_steps=DEFAULT_INFERENCE_STEPS if args.inference_steps is None else args.inference_steps,
+            guidance_scale=DEFAULT_GUIDANCE if args.guidance is None else args.guidance,
+            strength=args.strength,
+            seed=args.seed,
+            checkpoint=args.checkpoint,
+            scheduler=args.scheduler,
+            region_inpaint=args.region_inpaint,
+        )
+        print('Saved to', res["src"], 'with seed', res["seed"])
+        if res["checkpoint"] is not None:
+            print('Checkpoint', res["checkpoint"])
+
+    elif args.tool[0] in REFINE_ALIASES:
+        print('Refining checkpoint', args.prompt[0])
+        res = create_refinement(
+            checkpoint=args.prompt[0],
+            from_step=args.from_step,
             num_inference_steps=args.inference_steps,
             guidance_scale=args.guidance,
-            strength=args.strength,
+            outfile=args.out,
+            new_checkpoint=args.checkpoint,
+            scheduler=None if args.scheduler == DEFAULT_SCHEDULER else args.scheduler,
         )
+        print('Saved to', res["src"])
+        if res["checkpoint"] is not None:
+            print('Checkpoint', res["checkpoint"])
 
     elif args.tool[0] in REAL_ESRGAN_ALIASES:
         create_real_ersgan(args.prompt[0], args.scale, args.cartoon)
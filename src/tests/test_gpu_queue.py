@@ -0,0 +1,180 @@
+import threading
+import time
+
+import pytest
+
+from utils import gpu_queue
+from contextlib import contextmanager
+
+from utils.gpu_queue import GpuArbiter, QueueFullError, gpu_job, no_preemption, preemption_point, while_parked
+
+WAIT = 0.05
+
+def started(target):
+  thread = threading.Thread(target=target, daemon=True)
+  thread.start()
+  return thread
+
+def blocked(thread):
+  thread.join(WAIT)
+  return thread.is_alive()
+
+@pytest.fixture
+def arbiter(monkeypatch):
+  arbiter = GpuArbiter({'interactive': 2, 'normal': 1, 'bulk': 1}, {'interactive': None, 'normal': 2, 'bulk': 2})
+  monkeypatch.setattr(gpu_queue, 'arbiter', arbiter)
+  return arbiter
+
+def test_class_concurrency_limit(arbiter):
+  arbiter.acquire('normal')
+  second = started(lambda: arbiter.acquire('normal'))
+  assert blocked(second)
+  arbiter.release('normal')
+  second.join(1)
+  assert not second.is_alive()
+  assert arbiter.running['normal'] == 1
+
+def test_interactive_limit(arbiter):
+  arbiter.acquire('interactive')
+  arbiter.acquire('interactive')
+  third = started(lambda: arbiter.acquire('interactive'))
+  assert blocked(third)
+  arbiter.release('interactive')
+  third.join(1)
+  assert not third.is_alive()
+
+def test_lower_class_waits_for_higher(arbiter):
+  arbiter.acquire('interactive')
+  bulk = started(lambda: arbiter.acquire('bulk'))
+  assert blocked(bulk)
+  arbiter.release('interactive')
+  bulk.join(1)
+  assert not bulk.is_alive()
+
+def test_higher_class_runs_alongside_lower(arbiter):
+  arbiter.acquire('bulk')
+  interactive = started(lambda: arbiter.acquire('interactive'))
+  interactive.join(1)
+  assert not interactive.is_alive()
+
+def test_waiting_higher_class_goes_first(arbiter):
+  arbiter.acquire('normal')
+  order = []
+  normal = started(lambda: (arbiter.acquire('normal'), order.append('normal')))
+  bulk = started(lambda: (arbiter.acquire('bulk'), order.append('bulk')))
+  assert blocked(normal) and blocked(bulk)
+  arbiter.release('normal')
+  normal.join(1)
+  assert blocked(bulk)
+  arbiter.release('normal')
+  bulk.join(1)
+  assert order == ['normal', 'bulk']
+
+def test_preempt_without_higher_work(arbiter):
+  arbiter.acquire('bulk')
+  assert not arbiter.preempt('bulk')
+  assert arbiter.running['bulk'] == 1
+
+def test_preempt_yields_until_higher_work_is_done(arbiter):
+  arbiter.acquire('bulk')
+  arbiter.acquire('interactive')
+  preempted = []
+  bulk = started(lambda: preempted.append(arbiter.preempt('bulk')))
+  assert blocked(bulk)
+  assert arbiter.running['bulk'] == 0
+  arbiter.release('interactive')
+  bulk.join(1)
+  assert preempted == [True]
+  assert arbiter.running['bulk'] == 1
+
+def test_preemption_point_outside_of_a_job(arbiter):
+  arbiter.acquire('interactive')
+  assert not preemption_point()
+
+def test_preemption_point_in_a_job(arbiter):
+  log = []
+  def bulk_job():
+    with gpu_job('bulk'):
+      for step in range(6):
+        if preemption_point():
+          log.append('resumed')
+        log.append('bulk')
+        time.sleep(WAIT / 2)
+  bulk = started(bulk_job)
+  time.sleep(WAIT)
+  with gpu_job('interactive'):
+    log.append('interactive')
+    time.sleep(WAIT)
+  bulk.join(1)
+  assert 'resumed' in log
+  # the bulk job did not take another step while the interactive one ran
+  assert log[log.index('interactive') + 1] == 'resumed'
+
+def test_no_preemption(arbiter):
+  with gpu_job('bulk'):
+    arbiter.acquire('interactive')
+    with no_preemption():
+      assert not preemption_point()
+    assert arbiter.running['bulk'] == 1
+    arbiter.release('interactive')
+
+def test_nested_jobs_share_the_outer_slot(arbiter):
+  with gpu_job('normal'):
+    with gpu_job('normal'):
+      assert arbiter.running['normal'] == 1
+  assert arbiter.running['normal'] == 0
+
+def test_unknown_priority(arbiter):
+  with pytest.raises(ValueError):
+    with gpu_job('urgent'):
+      pass
+
+def test_queue_limit_rejects_instead_of_waiting(arbiter):
+  arbiter.admit('bulk')
+  arbiter.acquire('bulk')
+  done = threading.Event()
+  def queued_job():
+    with gpu_job('bulk'):
+      done.wait(1)
+  queued = started(queued_job)
+  assert blocked(queued)
+  with pytest.raises(QueueFullError):
+    with gpu_job('bulk'):
+      pass
+  assert arbiter.admitted['bulk'] == 2
+  arbiter.release('bulk')
+  arbiter.leave('bulk')
+  done.set()
+  queued.join(1)
+  assert not queued.is_alive()
+  assert arbiter.admitted['bulk'] == 0
+
+def test_queue_limit_is_per_class(arbiter):
+  arbiter.admit('bulk')
+  arbiter.admit('bulk')
+  with gpu_job('normal'):
+    pass
+  for _ in range(3):
+    arbiter.admit('interactive')
+
+def test_parking_hooks_wrap_preemption(arbiter):
+  log = []
+  @contextmanager
+  def parked():
+    log.append('parked')
+    yield
+    log.append('unparked')
+  running = threading.Event()
+  def bulk_job():
+    with gpu_job('bulk'), while_parked(parked):
+      running.set()
+      while not preemption_point():
+        time.sleep(0.001)
+      log.append('resumed')
+  bulk = started(bulk_job)
+  assert running.wait(1)
+  with gpu_job('interactive'):
+    time.sleep(WAIT)
+    log.append('interactive')
+  bulk.join(1)
+  assert log == ['parked', 'interactive', 'unparked', 'resumed']
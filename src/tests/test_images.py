@@ -0,0 +1,31 @@
+import numpy
+import pytest
+from PIL import Image
+
+from utils import images
+from utils.images import load_pil_image, load_rgb_array
+
+@pytest.fixture
+def image_path(monkeypatch, tmp_path):
+  monkeypatch.setattr(images, 'image_cache', images.OrderedDict())
+  monkeypatch.setattr(images, 'image_cache_bytes', 0)
+  path = str(tmp_path / 'image.png')
+  Image.fromarray(numpy.random.RandomState(0).randint(0, 256, (60, 80, 3), dtype=numpy.uint8)).save(path)
+  return path
+
+def test_rgb_array_is_cached_and_read_only(image_path):
+  array = load_rgb_array(image_path)
+  assert array.shape == (60, 80, 3) and array.dtype == numpy.uint8
+  assert load_rgb_array(image_path) is array
+  with pytest.raises(ValueError):
+    array[0, 0, 0] = 0
+
+def test_rgb_array_short_edge(image_path):
+  assert load_rgb_array(image_path, short_edge=30).shape == (30, 40, 3)
+
+def test_pil_image_is_a_copy(image_path):
+  cached = load_rgb_array(image_path).copy()
+  image = load_pil_image(image_path)
+  assert numpy.array_equal(numpy.asarray(image), cached)
+  image.putpixel((0, 0), tuple(255 - int(value) for value in cached[0, 0]))
+  assert numpy.array_equal(load_rgb_array(image_path), cached)
@@ -0,0 +1,132 @@
+import contextvars
+import threading
+import time
+
+import pytest
+import torch
+
+from utils import gpu_queue, memory
+from utils.gpu_queue import GpuArbiter, gpu_job, preemption_point
+from utils.memory import (
+  ATTENTION_PLANS,
+  InsufficientMemoryError,
+  attention_plan,
+  estimate_memory,
+  planned_attention,
+  planned_attention_forward,
+  reserve_memory,
+)
+
+GB = 2 ** 30
+WAIT = 0.05
+
+@pytest.fixture
+def budget(monkeypatch):
+  """Sets the device memory seen by reserve_memory, returning a function to change it"""
+  monkeypatch.setattr(memory, 'reserved_bytes', 0)
+  monkeypatch.setattr(memory, 'idle_budget', None)
+  monkeypatch.setattr(memory, 'MEMORY_HEADROOM', 0)
+  def set_budget(bytes):
+    monkeypatch.setattr(memory, 'available_memory', lambda: bytes)
+  return set_budget
+
+def test_reservations_are_released(budget):
+  budget(8 * GB)
+  with reserve_memory(512, 512) as plan:
+    assert memory.reserved_bytes == plan["estimate"]
+  assert memory.reserved_bytes == 0
+
+def test_running_generations_are_subtracted(budget):
+  total = estimate_memory(1024, 1024) + estimate_memory(512, 512)
+  budget(total)
+  with reserve_memory(1024, 1024) as first:
+    assert first["attention_chunk"] is None and not first["vae_tiling"]
+    # the device now reports what the first generation allocated as used, it must not be subtracted twice
+    budget(total - first["estimate"])
+    with reserve_memory(512, 512) as second:
+      assert second == {**ATTENTION_PLANS[0], "vae_tiling": False, "estimate": estimate_memory(512, 512)}
+    budget(total)
+  with reserve_memory(1024, 1024) as again:
+    assert again == first
+
+def test_contention_waits_for_running_generations(budget):
+  budget(estimate_memory(1024, 1024))
+  second = threading.Event()
+  def reserve():
+    with reserve_memory(1024, 1024):
+      second.set()
+  with reserve_memory(1024, 1024):
+    thread = threading.Thread(target=reserve, daemon=True)
+    thread.start()
+    assert not second.wait(WAIT)
+  thread.join(1)
+  assert second.is_set()
+  assert memory.reserved_bytes == 0
+
+def test_generation_too_large_for_idle_device_is_rejected(budget):
+  budget(estimate_memory(512, 512))
+  with reserve_memory(512, 512):
+    # would not fit even once the running generation is done, so waiting would never end
+    with pytest.raises(InsufficientMemoryError):
+      with reserve_memory(4096, 4096):
+        pass
+  assert memory.reserved_bytes == 0
+
+def test_preempted_generation_gives_its_reservation_back(budget, monkeypatch):
+  monkeypatch.setattr(gpu_queue, 'arbiter', GpuArbiter({'interactive': 1, 'normal': 1, 'bulk': 1}))
+  budget(estimate_memory(1024, 1024))
+  reserved, resumed = threading.Event(), threading.Event()
+  def background():
+    with gpu_job('bulk'), reserve_memory(1024, 1024):
+      reserved.set()
+      while not preemption_point():
+        time.sleep(0.001)
+      resumed.set()
+  thread = threading.Thread(target=background, daemon=True)
+  thread.start()
+  assert reserved.wait(1)
+  with gpu_job('interactive'), reserve_memory(1024, 1024):
+    assert memory.reserved_bytes == estimate_memory(1024, 1024)
+    assert not resumed.is_set()
+  thread.join(1)
+  assert resumed.is_set()
+  assert memory.reserved_bytes == 0
+
+def test_plan_is_per_context():
+  chunked = {**ATTENTION_PLANS[-1], "vae_tiling": True, "estimate": 0}
+  with planned_attention(chunked):
+    assert contextvars.copy_context().run(attention_plan.get)["attention_chunk"] == ATTENTION_PLANS[-1]["attention_chunk"]
+    assert contextvars.Context().run(attention_plan.get) == ATTENTION_PLANS[0]
+  assert attention_plan.get() == ATTENTION_PLANS[0]
+
+class Attention(torch.nn.Module):
+  """The parts of diffusers' CrossAttention planned_attention_forward relies on"""
+  def __init__(self, dim=8, heads=2):
+    super().__init__()
+    self.heads = heads
+    self.scale = (dim // heads) ** -0.5
+    self.to_q = torch.nn.Linear(dim, dim, bias=False)
+    self.to_k = torch.nn.Linear(dim, dim, bias=False)
+    self.to_v = torch.nn.Linear(dim, dim, bias=False)
+    self.to_out = torch.nn.Linear(dim, dim)
+
+  def reshape_heads_to_batch_dim(self, tensor):
+    batch, tokens, dim = tensor.shape
+    tensor = tensor.reshape(batch, tokens, self.heads, dim // self.heads).permute(0, 2, 1, 3)
+    return tensor.reshape(batch * self.heads, tokens, dim // self.heads)
+
+  def reshape_batch_dim_to_heads(self, tensor):
+    batch, tokens, dim = tensor.shape
+    tensor = tensor.reshape(batch // self.heads, self.heads, tokens, dim).permute(0, 2, 1, 3)
+    return tensor.reshape(batch // self.heads, tokens, dim * self.heads)
+
+@pytest.mark.parametrize('plan', ATTENTION_PLANS[1:] + [{"attention_slice": "auto", "attention_chunk": 3}])
+def test_planned_attention_matches_unplanned(plan):
+  torch.manual_seed(0)
+  module = Attention()
+  hidden_states = torch.randn(2, 10, 8)
+  with torch.no_grad():
+    expected = planned_attention_forward(module, hidden_states)
+    with planned_attention(plan):
+      actual = planned_attention_forward(module, hidden_states)
+  assert torch.allclose(actual, expected, atol=1e-6)
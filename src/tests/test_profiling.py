@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from utils import profiling
+from utils.profiling import profile_request, profiled, profiler_lock, saved_profiles
+
+@pytest.fixture
+def profile_dir(monkeypatch, tmp_path):
+  monkeypatch.setattr(profiling, 'PROFILE_DIR', str(tmp_path))
+  token = profile_request.set('request')
+  yield tmp_path
+  profile_request.reset(token)
+
+def test_profiles_request(profile_dir):
+  with profiled('inference'):
+    pass
+  assert sorted(os.listdir(profile_dir)) == ['request_inference_python.json', 'request_inference_torch.json']
+  assert not profiler_lock.locked()
+
+def test_skips_profiling_while_another_profile_is_recorded(profile_dir):
+  with profiled('outer'):
+    with profiled('inner'):
+      pass
+  assert sorted(os.listdir(profile_dir)) == ['request_outer_python.json', 'request_outer_torch.json']
+  assert not profiler_lock.locked()
+
+def test_releases_lock_on_error(profile_dir):
+  with pytest.raises(RuntimeError):
+    with profiled('inference'):
+      raise RuntimeError()
+  assert not profiler_lock.locked()
+
+def test_reports_only_saved_profiles(profile_dir):
+  saved = []
+  token = saved_profiles.set(saved)
+  try:
+    with profiled('outer'):
+      with profiled('inner'):
+        pass
+  finally:
+    saved_profiles.reset(token)
+  assert saved == ['outer']
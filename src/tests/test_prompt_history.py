@@ -0,0 +1,77 @@
+import sqlite3
+
+import pytest
+
+from utils import db
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+  monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'main.db'))
+  db.init_db()
+  return db.DB_PATH
+
+def prompts(results):
+  return [result["prompt"] for result in results]
+
+def test_add_prompt_counts_uses():
+  first = db.add_prompt('an astronaut riding a horse')
+  assert db.add_prompt('an astronaut riding a horse') == first
+  assert db.add_prompt('a red fox') != first
+  results = db.autocomplete_prompts('astro')
+  assert len(results) == 1
+  assert results[0]["uses"] == 2
+
+def test_autocomplete_most_used_first():
+  db.add_prompt('astronaut on the moon')
+  for _ in range(3):
+    db.add_prompt('astronaut riding a horse')
+  db.add_prompt('astronomy poster')
+  assert prompts(db.autocomplete_prompts('astro')) == [
+    'astronaut riding a horse', 'astronomy poster', 'astronaut on the moon']
+
+def test_autocomplete_every_word():
+  db.add_prompt('a red fox in the snow')
+  db.add_prompt('a red car')
+  assert prompts(db.autocomplete_prompts('red fo')) == ['a red fox in the snow']
+  assert prompts(db.autocomplete_prompts('fox r')) == ['a red fox in the snow']
+
+def test_popular_prompts_outlive_newer_matches(monkeypatch):
+  monkeypatch.setattr(db, 'PROMPT_SEARCH_CANDIDATES', 10)
+  for _ in range(5):
+    db.add_prompt('astronaut riding horse')
+  for index in range(30):
+    db.add_prompt('astronaut number {}'.format(index))
+  assert prompts(db.autocomplete_prompts('astro', limit=1)) == ['astronaut riding horse']
+  assert 'astronaut riding horse' in prompts(db.search_prompts('astronaut'))
+
+def test_search_ranks_best_match_first():
+  db.add_prompt('a castle on a hill at dawn in the style of an oil painting')
+  db.add_prompt('castle')
+  db.add_prompt('a dragon')
+  assert prompts(db.search_prompts('castle')) == [
+    'castle', 'a castle on a hill at dawn in the style of an oil painting']
+  assert db.search_prompts('unicorn') == []
+
+def test_empty_query_lists_recent_prompts():
+  db.add_prompt('first')
+  db.add_prompt('second')
+  assert prompts(db.autocomplete_prompts('')) == ['second', 'first']
+  assert prompts(db.search_prompts('  ')) == ['second', 'first']
+
+def test_linked_images():
+  prompt_id = db.add_prompt('a lighthouse')
+  image = db.add_image('outputs/lighthouse.png', 'a lighthouse', 512, 512, 1.0)
+  db.link_prompt_image(prompt_id, image["id"])
+  assert db.search_prompts('lighthouse')[0]["images"] == ['outputs/lighthouse.png']
+
+def test_punctuation_in_queries():
+  db.add_prompt('portrait, "studio_lighting", 4k')
+  assert prompts(db.autocomplete_prompts('"studio_li')) == ['portrait, "studio_lighting", 4k']
+
+def test_backfill_from_history(database):
+  with sqlite3.connect(database) as cur:
+    cur.execute("DELETE FROM prompts")
+    cur.executemany("INSERT INTO history (prompt, reference_image) VALUES (?, -1)", [('a cat',), ('a dog',), ('a cat',)])
+  db.init_db()
+  results = db.autocomplete_prompts('a')
+  assert [(result["prompt"], result["uses"]) for result in results] == [('a cat', 2), ('a dog', 1)]
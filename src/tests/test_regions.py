@@ -0,0 +1,69 @@
+import numpy
+import pytest
+from PIL import Image
+
+from utils.regions import crop_region, fit_mask, paste_region, region_size, region_window
+
+def box_mask(size: tuple, box: tuple):
+  mask = Image.new('L', size)
+  mask.paste(255, box)
+  return mask
+
+def test_window_pads_the_mask():
+  assert region_window(box_mask((512, 512), (200, 220, 260, 300)), padding=32) == (168, 188, 292, 332)
+
+@pytest.mark.parametrize('box, expected', [
+  ((0, 0, 40, 40), (0, 0, 104, 104)),
+  ((460, 470, 512, 512), (396, 406, 512, 512)),
+  ((0, 100, 512, 140), (0, 36, 512, 204)),
+])
+def test_window_is_clamped_to_the_image(box, expected):
+  assert region_window(box_mask((512, 512), box), padding=64) == expected
+
+def test_empty_mask():
+  with pytest.raises(ValueError):
+    region_window(Image.new('L', (64, 64)))
+
+@pytest.mark.parametrize('window', [(0, 0, 100, 100), (10, 20, 333, 129), (0, 0, 1000, 30), (5, 5, 17, 900)])
+def test_region_size_fits_the_unet(window):
+  width, height = region_size(window, native=512)
+  # multiples of 64, so of the 8 pixels per latent and the 32 preprocess_image crops to
+  assert width % 64 == 0 and height % 64 == 0
+  assert max(width, height) == 512
+  assert min(width, height) >= 64
+
+def test_region_size_keeps_the_aspect_ratio():
+  assert region_size((0, 0, 300, 150), native=512) == (512, 256)
+
+def test_crop_region_resizes_to_region_size():
+  image = Image.new('RGB', (1024, 768))
+  mask = box_mask((1024, 768), (500, 300, 600, 380))
+  window = region_window(mask)
+  region_image, region_mask = crop_region(image, mask, window)
+  assert region_image.size == region_mask.size == region_size(window)
+
+def test_fit_mask():
+  mask = fit_mask(Image.new('RGB', (32, 32), 'white'), (64, 48))
+  assert mask.mode == 'L' and mask.size == (64, 48)
+
+def test_feathered_paste_blends_inside_the_mask_only():
+  image = Image.new('RGB', (256, 256), 'black')
+  mask = box_mask((256, 256), (96, 96, 160, 160))
+  window = region_window(mask, padding=32)
+  region = Image.new('RGB', region_size(window, native=128), 'white')
+  result = numpy.asarray(paste_region(image, mask, region, window, feather=4))[:, :, 0]
+  # fully the region well inside the mask, untouched well outside it, and blended in between
+  assert (result[110:146, 110:146] == 255).all()
+  assert (result[:80] == 0).all() and (result[176:] == 0).all()
+  assert (result[:, :80] == 0).all() and (result[:, 176:] == 0).all()
+  assert 0 < result[128, 96] < 255
+
+def test_paste_without_feathering_follows_the_mask():
+  image = Image.new('RGB', (128, 128), 'black')
+  mask = box_mask((128, 128), (32, 32, 64, 64))
+  window = region_window(mask, padding=16)
+  region = Image.new('RGB', region_size(window, native=64), 'white')
+  result = numpy.array(paste_region(image, mask, region, window, feather=0))[:, :, 0]
+  assert (result[32:64, 32:64] == 255).all()
+  result[32:64, 32:64] = 0
+  assert (result == 0).all()
@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from utils.single_flight import flight_key, flights, single_flight
+
+WAIT = 0.05
+
+def concurrent_calls(count: int, key, compute):
+  """Calls single_flight from count threads at once, returning their results (or errors) in call order"""
+  results = [None] * count
+  def call(index):
+    try:
+      results[index] = single_flight('test', key, compute)
+    except Exception as error:
+      results[index] = error
+  threads = [threading.Thread(target=call, args=(index,), daemon=True) for index in range(count)]
+  for thread in threads:
+    thread.start()
+  return threads, results
+
+def test_identical_calls_share_one_computation():
+  release = threading.Event()
+  calls = []
+  def compute():
+    calls.append(1)
+    release.wait(1)
+    return {"src": "output/shared.png"}
+  threads, results = concurrent_calls(4, 'shared', compute)
+  # let every thread join the flight before it completes
+  time.sleep(WAIT)
+  release.set()
+  for thread in threads:
+    thread.join(1)
+  assert len(calls) == 1
+  assert all(result is results[0] for result in results)
+  assert results[0] == {"src": "output/shared.png"}
+
+def test_errors_reach_every_waiter():
+  release = threading.Event()
+  def compute():
+    release.wait(1)
+    raise ValueError('failed')
+  threads, results = concurrent_calls(3, 'failing', compute)
+  # let every thread join the flight before it completes
+  time.sleep(WAIT)
+  release.set()
+  for thread in threads:
+    thread.join(1)
+  assert all(isinstance(result, ValueError) for result in results)
+
+def test_key_is_cleared_afterwards():
+  calls = []
+  compute = lambda: calls.append(1) or len(calls)
+  assert single_flight('test', 'again', compute) == 1
+  assert 'again' not in flights
+  assert single_flight('test', 'again', compute) == 2
+
+def test_key_is_cleared_after_an_error():
+  def compute():
+    raise ValueError('failed')
+  with pytest.raises(ValueError):
+    single_flight('test', 'error', compute)
+  assert 'error' not in flights
+  assert single_flight('test', 'error', lambda: 'ok') == 'ok'
+
+def test_flight_key(tmp_path):
+  path = tmp_path / 'input.png'
+  path.write_bytes(b'first')
+  assert flight_key('upscale', str(path), scale=2) == flight_key('upscale', str(path), scale=2.0)
+  assert flight_key('upscale', str(path), scale=2) != flight_key('upscale', str(path), scale=3)
+  before = flight_key('upscale', str(path), scale=2)
+  path.write_bytes(b'overwritten')
+  assert flight_key('upscale', str(path), scale=2) != before
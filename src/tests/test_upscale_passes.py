@@ -0,0 +1,65 @@
+import math
+
+import numpy
+import pytest
+
+pytest.importorskip('realesrgan')
+pytest.importorskip('fastapi')
+
+import cv2
+
+from transforms import real_ersgan
+from transforms.real_ersgan import MAX_PASS_SCALE, model_scale, upscale_cv_image, upscale_passes
+
+@pytest.mark.parametrize('scale, expected', [
+  (1.5, 2),
+  (2, 2),
+  (3, 4),
+  (4, 4),
+])
+def test_model_scale(scale, expected):
+  assert model_scale(False, scale) == expected
+  # the anime model only comes as x4
+  assert model_scale(True, scale) == 4
+
+@pytest.mark.parametrize('scale, expected', [
+  (2, [(2, 2)]),
+  (3, [(4, 3)]),
+  (4, [(4, 4)]),
+  (6, [(4, 4), (2, 1.5)]),
+  (8, [(4, 4), (2, 2)]),
+  (12, [(4, 4), (4, 3)]),
+  (16, [(4, 4), (4, 4)]),
+  (32, [(4, 4), (4, 4), (2, 2)]),
+])
+def test_upscale_passes(scale, expected):
+  passes = upscale_passes(False, scale)
+  assert passes == expected
+  assert math.isclose(math.prod(outscale for _, outscale in passes), scale)
+  assert all(outscale <= model for model, outscale in passes)
+  assert all(model <= MAX_PASS_SCALE for model, _ in passes)
+
+def test_anime_passes_use_x4():
+  assert upscale_passes(True, 8) == [(4, 4), (4, 2)]
+
+class ResizingUpsampler:
+  """Stands in for RealESRGANer.enhance, which runs the model then resizes its output to outscale"""
+  def __init__(self, log: list, native_scale: int):
+    self.log = log
+    self.native_scale = native_scale
+
+  def enhance(self, img, outscale):
+    self.log.append((self.native_scale, outscale))
+    height, width = img.shape[:2]
+    return cv2.resize(img, (int(width * outscale), int(height * outscale))), None
+
+@pytest.mark.parametrize('scale', [1.5, 2, 3, 4, 8, 16])
+def test_final_size(monkeypatch, scale):
+  log = []
+  monkeypatch.setattr(
+    real_ersgan, 'get_upsampler',
+    lambda for_anime, outscale: ResizingUpsampler(log, model_scale(for_anime, outscale)))
+  img = numpy.zeros((16, 24, 3), dtype=numpy.uint8)
+  output = upscale_cv_image(img, scale)
+  assert output.shape == (int(16 * scale), int(24 * scale), 3)
+  assert log == upscale_passes(False, scale)
@@ -1,38 +1,43 @@
 from typing import Optional
 
-import cv2
 from PIL import Image
 from pathlib import Path
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
-from transforms.real_ersgan import get_upsampler
+from transforms.real_ersgan import ScaleAwareUpsampler
 from utils.db import add_image_file
 from utils.GFPGANer import GFPGANer
+from utils.gpu_queue import PRIORITIES, QueueFullError, gpu_job
 from utils.file_utils import cache_remote_file, get_png_filename, trim_path
-from utils.images import opencv2pil
+from utils.metrics import in_flight, logger, record_model_cache, timed
+from utils.profiling import profiled
+from utils.single_flight import flight_key, single_flight
+from utils.images import load_cv_image, opencv2pil
 
 router = APIRouter()
 
 MODEL_URL = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth'
 MODEL_NAME = 'GFPGANv1.3.pth'
 
-cached_restorers = {}
-def get_restorer(scale: float):
-  global cached_restorers
+cached_restorer = None
+@timed('model_acquisition')
+def get_restorer():
+  """Memoizes the GFPGAN restorer, which is shared by every scale (the scale is given to each enhance call)"""
+  global cached_restorer
 
-  if scale not in cached_restorers:
+  record_model_cache('gfpgan', cached_restorer is not None)
+  if cached_restorer is None:
     path_to_model = cache_remote_file(MODEL_URL, MODEL_NAME)
-    cached_restorers[scale] = GFPGANer(
+    cached_restorer = GFPGANer(
       model_path=path_to_model,
-      upscale=scale, # can do upscaling at the same time? should we do that here
+      upscale=1,
       arch='clean', # used for the GFPGANv1.3 model
       channel_multiplier = 2, # used for the GFPGANv1.3 model
-      bg_upsampler = None if scale == 1 else get_upsampler(for_anime=False) # gfpgan doesn't work well for cartoons anyways
     )
-  return cached_restorers[scale]
+  return cached_restorer
 
 def prefetch():
-  get_restorer(1.0)
+  get_restorer()
 
 def gfpgan_image(
   input_image,
@@ -53,12 +58,20 @@ def gfpgan_image(
   :return: Restored Image
   :rtype: PIL.Image
   """
-  restorer = get_restorer(scale)
-  cropped_faces, restored_faces, restored_img = restorer.enhance(
-            img, has_aligned=prealligned, only_center_face=only_center_face, paste_back=True)
+  restorer = get_restorer()
+  # gfpgan doesn't work well for cartoons anyways
+  bg_upsampler = None if scale == 1 else ScaleAwareUpsampler(for_anime=False)
+  with timed('gfpgan.inference'), profiled('gfpgan'):
+    cropped_faces, restored_faces, restored_img = restorer.enhance(
+              input_image,
+              has_aligned=prealligned,
+              only_center_face=only_center_face,
+              paste_back=True,
+              upscale=scale,
+              bg_upsampler=bg_upsampler)
   # ignore cropped_faces and restored_faces return values
 
-  return opencv2pil(restored_image)
+  return opencv2pil(restored_img)
 
 def gfpgan_file(
   input_image: str,
@@ -79,8 +92,8 @@ def gfpgan_file(
   :return: Restored Image
   :rtype: PIL.Image
   """
-  img = cv2.imread(input_image, cv2.IMREAD_COLOR)
-  return gfpgan_image(img, only_center_face, prealligned)
+  img = load_cv_image(input_image)
+  return gfpgan_image(img, scale, only_center_face, prealligned)
 
 
 @router.post("/transforms/gfpgan")
@@ -90,6 +103,7 @@ def create_gfpgan(
   outfile: Optional[str] = None,
   only_center_face: Optional[bool] = False,
   prealligned: Optional[bool] = False,
+  priority: str = 'normal',
 ):
   """Uses [GFPGANv1.3 Model](https://github.com/TencentARC/GFPGAN) to restore faces in photos
 
@@ -103,18 +117,36 @@ def create_gfpgan(
   :type only_center_face: Optional[bool], optional
   :param prealligned: If true, treats the image as having a correct allignment, defaults to false
   :type prealligned: Optional[bool], optional
+  :param priority: Priority class of the restoration (interactive, normal or bulk), defaults to normal
+  :type priority: str, optional
   :return: Restored Image
   :rtype: PIL.Image
   """
-  img = gfpgan_file(input_image=input_image, only_center_face=only_center_face, prealligned=prealligned)
-  if outfile is None:
-    outfile = get_png_filename('face_' + Path(args.prompt[0]).stem)
-  print('Saving face fix to ', outfile)
-  img.save(outfile)
-
-  return add_image_file(
-    trim_path(outfile),
-    "GFPGAN Face Restoration of " + input_image,
-    input_image,
-    img
-  )
+  if priority not in PRIORITIES:
+    raise HTTPException(status_code=400, detail="Unknown priority " + priority)
+
+  def compute():
+    nonlocal outfile
+    try:
+      with in_flight('gfpgan'), gpu_job(priority):
+        img = gfpgan_file(input_image=input_image, scale=scale, only_center_face=only_center_face, prealligned=prealligned)
+    except QueueFullError as error:
+      raise HTTPException(status_code=503, detail=str(error))
+    if outfile is None:
+      outfile = get_png_filename('face_' + Path(input_image).stem)
+    logger.info('Saving face fix to %s', outfile)
+    with timed('encode_save'):
+      img.save(outfile)
+
+    return add_image_file(
+      trim_path(outfile),
+      "GFPGAN Face Restoration of " + input_image,
+      input_image,
+      img
+    )
+
+  # retries and double submits of a request still in progress share its result (and output file)
+  key = flight_key(
+    'gfpgan', input_image,
+    scale=scale, outfile=outfile, only_center_face=bool(only_center_face), prealligned=bool(prealligned))
+  return single_flight('gfpgan', key, compute)
@@ -1,4 +1,6 @@
+import copy
 import os
+from contextlib import contextmanager
 from typing import Optional
 
 import cv2
@@ -7,10 +9,15 @@ from realesrgan import RealESRGANer
 from realesrgan.archs.srvgg_arch import SRVGGNetCompact
 from PIL import Image
 from pathlib import Path
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
 from utils.db import add_image_file
 from utils.file_utils import cache_remote_file, get_png_filename, trim_path
+from utils.gpu_queue import PRIORITIES, QueueFullError, gpu_job, preemption_point, while_parked
+from utils.images import load_cv_image
+from utils.metrics import in_flight, logger, record_model_cache, timed
+from utils.profiling import profiled
+from utils.single_flight import flight_key, single_flight
 
 router = APIRouter()
 
@@ -23,44 +30,112 @@ HALF_PRECISION = bool(os.getenv('USE_HALF_PRECISION', ''))
 
 
 SIMPLE_MODEL_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.1.0/RealESRGAN_x4plus.pth'
+SIMPLE_X2_MODEL_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth'
 ANIME_MODEL_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.5.0/realesr-animevideov3.pth'
 
 SIMPLE_MODEL_NAME = 'RealESRGAN_x4plus.pth'
+SIMPLE_X2_MODEL_NAME = 'RealESRGAN_x2plus.pth'
 ANIME_MODEL_NAME = 'realesr-animevideov3.pth'
 
-cached_simple = None
-cached_anime = None
-def get_upsampler(for_anime: bool = False):
-  global cached_simple, cached_anime
-  basic_params = {
-    "tile": IMAGE_TILE_SIZE,
-    "tile_pad": IMAGE_TILE_BORDER,
-    "half": HALF_PRECISION,
-    "scale": 4,
-  }
+# Largest factor a single model pass upscales by, bigger factors take several passes
+MAX_PASS_SCALE = 4
+
+cached_upsamplers = {}
+
+def preemptible(upsampler: RealESRGANer):
+  """Makes the upsampler yield to higher priority work between tiles, which are each a forward pass of its model"""
+  def on_tile(module, inputs):
+    preemption_point()
+    # anything but None returned by a forward pre-hook replaces the module's input
+    return None
+  upsampler.model.register_forward_pre_hook(on_tile)
+  return upsampler
+
+@contextmanager
+def offloaded_output(upsampler: RealESRGANer):
+  """Moves the partial output of an upsampler to the CPU while its job is parked, and back before it resumes.
+  The output is scale^2 times the size of the input, by far the largest tensor a parked upscale holds"""
+  output = getattr(upsampler, 'output', None)
+  if output is None or output.device.type == 'cpu':
+    yield
+    return
+  device = output.device
+  upsampler.output = output.cpu()
+  del output
+  try:
+    yield
+  finally:
+    upsampler.output = upsampler.output.to(device)
+
+def model_scale(for_anime: bool, scale: float):
+  """Native scale of the model used for a single pass upscaling by scale (at most MAX_PASS_SCALE).
+  The anime model only comes as x4"""
+  return 2 if scale <= 2 and not for_anime else 4
+
+def upscale_passes(for_anime: bool, scale: float):
+  """(model scale, outscale) of each pass upscaling by scale takes, x4 passes until the rest fits in one pass"""
+  passes = []
+  while scale > MAX_PASS_SCALE:
+    passes.append((MAX_PASS_SCALE, MAX_PASS_SCALE))
+    scale /= MAX_PASS_SCALE
+  passes.append((model_scale(for_anime, scale), scale))
+  return passes
+
+@timed('model_acquisition')
+def get_upsampler(for_anime: bool = False, scale: float = 4):
+  """Memoizes the upsampler for a single pass upscaling by scale, the x2 model for scales up to 2 and
+  the x4 one otherwise, so that no more pixels are computed than kept.
+
+  RealESRGANer keeps the image being upscaled on the instance, so every call gets its own shallow copy
+  sharing the model weights, and jobs preempted between tiles cannot overwrite each other's state"""
+  native_scale = model_scale(for_anime, scale)
+  key = (for_anime, native_scale)
   if for_anime:
-    if cached_anime is None:
-      path_to_model = cache_remote_file(ANIME_MODEL_URL, ANIME_MODEL_NAME)
-      cached_anime = RealESRGANer(
-        model_path = path_to_model,
-        model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu'),
-        **basic_params
-      )
-    return cached_anime
+    record_model_cache('real_esrgan_anime', key in cached_upsamplers)
   else:
-    if cached_simple is None:
+    record_model_cache('real_esrgan_x{}'.format(native_scale), key in cached_upsamplers)
+  if key not in cached_upsamplers:
+    basic_params = {
+      "tile": IMAGE_TILE_SIZE,
+      "tile_pad": IMAGE_TILE_BORDER,
+      "half": HALF_PRECISION,
+      "scale": native_scale,
+    }
+    if for_anime:
+      path_to_model = cache_remote_file(ANIME_MODEL_URL, ANIME_MODEL_NAME)
+      model = SRVGGNetCompact(num_in_ch=3, num_out_ch=3, num_feat=64, num_conv=16, upscale=4, act_type='prelu')
+    elif native_scale == 2:
+      path_to_model = cache_remote_file(SIMPLE_X2_MODEL_URL, SIMPLE_X2_MODEL_NAME)
+      model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+    else:
       path_to_model = cache_remote_file(SIMPLE_MODEL_URL, SIMPLE_MODEL_NAME)
-      cached_simple = RealESRGANer(
-        model_path = path_to_model,
-        model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4),
-        **basic_params
-      )
-    return cached_simple
+      model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=4)
+    cached_upsamplers[key] = preemptible(RealESRGANer(model_path = path_to_model, model = model, **basic_params))
+  return copy.copy(cached_upsamplers[key])
 
 def prefetch():
   """Build every pipe necessary for real ersgan"""
-  get_upsampler(false)
-  get_upsampler(true)
+  get_upsampler(False, 2)
+  get_upsampler(False, 4)
+  get_upsampler(True, 4)
+
+def upscale_cv_image(input_image, scale: float, for_anime: bool = False):
+  """Upscales a CV2 Image Mat by scale, in as many passes as upscale_passes takes, returning a CV2 Image Mat"""
+  output = input_image
+  for _, outscale in upscale_passes(for_anime, scale):
+    upsampler = get_upsampler(for_anime, outscale)
+    with while_parked(lambda: offloaded_output(upsampler)):
+      output, _ = upsampler.enhance(output, outscale = outscale)
+  return output
+
+class ScaleAwareUpsampler():
+  """Drop-in for RealESRGANer.enhance picking the models by requested scale, e.g. as GFPGAN's background upsampler"""
+
+  def __init__(self, for_anime: bool = False):
+    self.for_anime = for_anime
+
+  def enhance(self, img, outscale=4):
+    return upscale_cv_image(img, outscale, self.for_anime), None
 
 def real_ersgan_image(
   input_image,
@@ -78,8 +153,8 @@ def real_ersgan_image(
   :return: Upscaled image
   :rtype: PIL.Image
   """
-  upsampler = get_upsampler(for_anime)
-  output, _ = upsampler.enhance(input_image, outscale = scale)
+  with timed('real_esrgan.inference'), profiled('real_esrgan'):
+    output = upscale_cv_image(input_image, scale, for_anime)
   output = cv2.cvtColor(output, cv2.COLOR_BGR2RGB)
   return Image.fromarray(output)
 
@@ -100,7 +175,7 @@ def real_ersgan_file(
   :return: Upscaled image
   :rtype: PIL.Image
   """
-  img = cv2.imread(input_image, cv2.IMREAD_COLOR)
+  img = load_cv_image(input_image)
   return real_ersgan_image(img, scale, for_anime)
 
 @router.post("/transforms/real-ersgan")
@@ -109,6 +184,7 @@ def create_real_ersgan(
   scale: int = 2.0,
   outfile: Optional[str] = None,
   for_anime: Optional[bool] = False,
+  priority: str = 'bulk',
 ):
   """Uses [Real-ERSGAN](https://github.com/xinntao/Real-ESRGAN) model for image upscaling
 
@@ -120,19 +196,34 @@ def create_real_ersgan(
   :type persist: Optional[str], optional
   :param for_anime: If true, uses a different model optemized for cartoons/anime, defaults to False
   :type for_anime: Optional[bool], optional
+  :param priority: Priority class of the upscale (interactive, normal or bulk), defaults to bulk
+  :type priority: str, optional
   :return: Path to persisted image
   :rtype: str
   """
-
-  img = real_ersgan(input_image=input_image, scale=scale, for_anime=for_anime)
-  if outfile is None:
-    outfile = get_png_filename('upscale_' + Path(input_image).stem)
-  print("Saving upscaled image to ", outfile)
-  img.save(outfile)
-
-  return add_image_file(
-    trim_path(outfile),
-    "Real-ERSGAN Upscaling of " + input_image,
-    input_image,
-    img
-  )
\ No newline at end of file
+  if priority not in PRIORITIES:
+    raise HTTPException(status_code=400, detail="Unknown priority " + priority)
+
+  def compute():
+    nonlocal outfile
+    try:
+      with in_flight('real_esrgan'), gpu_job(priority):
+        img = real_ersgan_file(input_image=input_image, scale=scale, for_anime=for_anime)
+    except QueueFullError as error:
+      raise HTTPException(status_code=503, detail=str(error))
+    if outfile is None:
+      outfile = get_png_filename('upscale_' + Path(input_image).stem)
+    logger.info("Saving upscaled image to %s", outfile)
+    with timed('encode_save'):
+      img.save(outfile)
+
+    return add_image_file(
+      trim_path(outfile),
+      "Real-ERSGAN Upscaling of " + input_image,
+      input_image,
+      img
+    )
+
+  # retries and double submits of a request still in progress share its result (and output file)
+  key = flight_key('real_esrgan', input_image, scale=scale, outfile=outfile, for_anime=bool(for_anime))
+  return single_flight('real_esrgan', key, compute)
\ No newline at end of file
@@ -1,18 +1,30 @@
+import copy
 import os
+import random
 import sys
 from typing import Optional, Union
 
-from diffusers import (StableDiffusionImg2ImgPipeline,
-                       StableDiffusionInpaintPipeline, StableDiffusionPipeline)
+import torch
+from diffusers import StableDiffusionPipeline
 from PIL import Image
 from torch import autocast, float16
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
 from transforms.gfpgan import gfpgan_image
 from transforms.real_ersgan import real_ersgan_image
-from utils.db import add_image_file, add_prompt
+from utils.db import add_image_file, add_prompt, link_prompt_image
+from utils.denoise import (decode, denoise, encode_prompt, reschedule,
+                           start_img2img, start_txt2img)
 from utils.file_utils import get_png_filename, trim_path
-from utils.images import pil2opencv
+from utils.images import load_pil_image, load_rgb_array, pil2opencv
+from utils.latent_cache import (LATENT_CHECKPOINT_INTERVAL, load_checkpoint,
+                                new_checkpoint_id, save_checkpoint)
+from utils.gpu_queue import PRIORITIES, QueueFullError, gpu_job, preemption_point
+from utils.memory import InsufficientMemoryError, planned_attention, reserve_memory, use_planned_attention
+from utils.metrics import in_flight, logger, record_model_cache, timed
+from utils.profiling import profiled
+from utils.regions import crop_region, fit_mask, paste_region, region_window
+from utils.schedulers import DEFAULT_SCHEDULER, SCHEDULER_NAMES, get_scheduler
 
 router = APIRouter()
 
@@ -29,37 +41,93 @@ pipeline_params = {
     "use_auth_token": HF_API_TOKEN
 }
 
+# txt2img, img2img and inpainting all run through utils.denoise, which only needs the model
+# components, so a single pipeline is loaded and shared between them
 pipelines = {
   'txt2img': StableDiffusionPipeline,
-  'img2img': StableDiffusionImg2ImgPipeline,
-  'inpaint': StableDiffusionInpaintPipeline
 }
 
 pipes = {}
 
+@timed('model_acquisition')
 def get_pipe(pipeline: str):
     """Memoizes the retrieval of a pipeline operating upon the model"""
     global pipelines, pipes
+    record_model_cache('stable_diffusion', pipeline in pipes)
     if pipeline not in pipes:
         pipes[pipeline] = pipelines[pipeline].from_pretrained(**pipeline_params).to("cuda")
+        use_planned_attention(pipes[pipeline].unet)
     return pipes[pipeline]
 
 def prefetch():
     """Build every pipe necessary for stable diffusion"""
     for key in pipelines.keys():
-        get_pipe(pipelines[key])
+        get_pipe(key)
 
 def load_image(img_prompt: str):
-    img = Image.open(img_prompt).convert("RGB")
-    width, height = img.size
-    if width == height == 512:
-        return img
-    if width < height:
-        return img.resize((512, int(512 * height / width)))
-    else:
-        return img.resize((int(512 * width / height), 512))
+    """Loads an input image with its shorter edge resized to 512, the resolution the model works best at,
+    as the cached RGB array, which preprocess_image reads without copying"""
+    return load_rgb_array(img_prompt, short_edge=512)
 
 
+def random_seed():
+    return random.randrange(2 ** 32)
+
+def region_inputs(img_prompt: str, img_mask: str):
+    """Full resolution input image and its mask, resized to match, for region inpainting"""
+    image = load_pil_image(img_prompt)
+    return image, fit_mask(load_pil_image(img_mask), image.size)
+
+def checkpoint_saver(steps: dict, interval: int = LATENT_CHECKPOINT_INTERVAL):
+    """Builds an on_step callback for utils.denoise which collects the latents and scheduler state
+    every `interval` steps, plus the final latents, into `steps`"""
+    first_step = []
+    def on_step(index, latents, scheduler):
+        if not first_step:
+            first_step.append(index)
+        if (index - first_step[0]) % interval == 0 or index == len(scheduler.timesteps):
+            steps[index] = {
+                "latents": latents.detach().cpu(),
+                "scheduler": copy.deepcopy(scheduler),
+            }
+    return on_step
+
+def run_denoise(pipe, scheduler, state: dict, meta: dict, checkpoint: Optional[str] = None):
+    """Denoises and decodes a state, saving a checkpoint of the generation under `checkpoint` if defined
+
+    :raises InsufficientMemoryError: If the generation is too large for the device
+    """
+    height, width = [size * 8 for size in state["latents"].shape[-2:]]
+    # the plan is per generation: the pipe is shared by concurrent generations, and each reserves its own memory
+    with reserve_memory(width, height, guidance=meta["guidance_scale"] > 1.0) as plan, planned_attention(plan):
+        steps = {}
+        save_step = None if checkpoint is None else checkpoint_saver(steps)
+        def on_step(index, latents, scheduler):
+            if save_step is not None:
+                save_step(index, latents, scheduler)
+            # step boundaries are where higher priority work may take the device over
+            preemption_point()
+
+        with timed('stable_diffusion.inference'), profiled('stable_diffusion'):
+            text_embeddings = encode_prompt(pipe, meta["prompt"], meta["guidance_scale"])
+            latents = denoise(
+                pipe,
+                scheduler,
+                state,
+                text_embeddings,
+                meta["guidance_scale"],
+                meta["eta"],
+                on_step=on_step)
+        if checkpoint is not None:
+            with timed('stable_diffusion.checkpoint'):
+                save_checkpoint(checkpoint, {
+                    "meta": meta,
+                    "steps": steps,
+                    "inpaint": {key: state[key].cpu() for key in ["init_latents", "noise", "mask"] if key in state},
+                })
+        with timed('stable_diffusion.decode'):
+            return decode(pipe, latents, tiled=plan["vae_tiling"])
+
 def stable_diffusion(
     prompt: str,
     width: int = 512,
@@ -70,6 +138,10 @@ def stable_diffusion(
     guidance_scale: float = 7.5,
     eta: float = 0.0,
     strength: float = 0.8,
+    seed: Optional[int] = None,
+    checkpoint: Optional[str] = None,
+    scheduler: str = DEFAULT_SCHEDULER,
+    region_inpaint: bool = False,
 ):
     """Runs [Stable Diffusion](https://github.com/CompVis/stable-diffusion) models to generate an image
 
@@ -91,33 +163,147 @@ def stable_diffusion(
     :type eta: float, optional
     :param strength: Value between 0.0-1.0 that controls the amount of noise that is added to the input image. Values that approach 1.0 will be less semantically consistent with the input image, defaults to 0.75
     :type strength: float, optional
+    :param seed: Seed for the initial noise, random if not defined
+    :type seed: Optional[int], optional
+    :param checkpoint: If defined, the intermediate latents are saved under this id (see utils.latent_cache) so the generation can later be refined
+    :type checkpoint: Optional[str], optional
+    :param scheduler: Sampler used for denoising, one of utils.schedulers.SCHEDULER_NAMES, defaults to the model's own
+    :type scheduler: str, optional
+    :param region_inpaint: If set to true when inpainting, only a window around the mask is diffused, at the model's native resolution, and pasted back into the full resolution input image (see utils.regions)
+    :type region_inpaint: bool, optional
     :return: Generated PIL.Image
     :rtype: PIL.Image
+    :raises InsufficientMemoryError: If the requested size cannot fit in device memory
+    :raises ValueError: If region inpainting with an empty mask
     """
     reasonable_size = lambda x: int(x / 8) * 8 if (x > 0 and x < 8192) else 512
-    generator_params = {
+    if seed is None:
+        seed = random_seed()
+    meta = {
         "prompt": prompt,
+        "width": reasonable_size(width),
+        "height": reasonable_size(height),
+        "img_prompt": img_prompt,
+        "img_mask": img_mask,
         "num_inference_steps": num_inference_steps,
         "guidance_scale": guidance_scale,
         "eta": eta,
-        "strength": strength
+        "strength": strength,
+        "seed": seed,
+        "scheduler": scheduler,
+        "region": None,
     }
 
-    if img_prompt is None:
-        with autocast("cuda"):
-            return get_pipe('txt2img')(
-                    width=reasonable_size(width),
-                    height=reasonable_size(height),
-                    **generator_params).images[0]
-    else:
-        generator_params["init_image"] = load_image(img_prompt)
-        if img_mask is None:
-            with autocast("cuda"):
-                return get_pipe('img2img')(**generator_params).images[0]
+    pipe = get_pipe('txt2img')
+    noise_scheduler = get_scheduler(pipe, scheduler)
+    generator = torch.Generator(device=pipe.unet.device).manual_seed(seed)
+    with torch.no_grad(), autocast("cuda"):
+        if img_prompt is None:
+            state = start_txt2img(pipe, noise_scheduler, meta["width"], meta["height"], num_inference_steps, generator)
+        elif region_inpaint and img_mask is not None:
+            image, mask = region_inputs(img_prompt, img_mask)
+            meta["region"] = region_window(mask)
+            region_image, region_mask = crop_region(image, mask, meta["region"])
+            state = start_img2img(pipe, noise_scheduler, region_image, strength, num_inference_steps, generator, region_mask)
+            region = run_denoise(pipe, noise_scheduler, state, meta, checkpoint)
+            return paste_region(image, mask, region, meta["region"])
         else:
-            generator_params["mask_image"] = Image.open(img_mask).convert(
-                "RGB")
-            return get_pipe('inpaint')(**generator_params).images[0]
+            mask_image = None if img_mask is None else load_pil_image(img_mask)
+            state = start_img2img(pipe, noise_scheduler, load_image(img_prompt), strength, num_inference_steps, generator, mask_image)
+        return run_denoise(pipe, noise_scheduler, state, meta, checkpoint)
+
+def refine(
+    checkpoint: str,
+    from_step: Optional[int] = None,
+    num_inference_steps: Optional[int] = None,
+    guidance_scale: Optional[float] = None,
+    prompt: Optional[str] = None,
+    new_checkpoint: Optional[str] = None,
+    scheduler: Optional[str] = None,
+):
+    """Continues a checkpointed generation from one of its intermediate steps, skipping the steps before it
+
+    :param checkpoint: Id the generation was checkpointed under
+    :type checkpoint: str
+    :param from_step: Denoising step to resume from, rounded down to the closest saved step. Defaults to the last intermediate step saved
+    :type from_step: Optional[int], optional
+    :param num_inference_steps: If defined and different from the original, the remaining denoising follows a schedule of this many steps, e.g. to finish a quick draft at higher quality
+    :type num_inference_steps: Optional[int], optional
+    :param guidance_scale: If defined, overrides the guidance scale of the original generation
+    :type guidance_scale: Optional[float], optional
+    :param prompt: If defined, overrides the prompt of the original generation
+    :type prompt: Optional[str], optional
+    :param new_checkpoint: If defined, the refined generation is itself checkpointed under this id
+    :type new_checkpoint: Optional[str], optional
+    :param scheduler: If defined and different from the original, the remaining denoising uses this sampler
+    :type scheduler: Optional[str], optional
+    :return: Generated PIL.Image
+    :rtype: PIL.Image
+    :raises FileNotFoundError: If the checkpoint does not exist (anymore)
+    :raises ValueError: If there is no saved step to resume from
+    """
+    pipe = get_pipe('txt2img')
+    saved = load_checkpoint(checkpoint, device=pipe.unet.device)
+    steps = saved["steps"]
+    final_step = max(steps.keys())
+    if from_step is None:
+        from_step = max([step for step in steps.keys() if step < final_step], default=min(steps.keys()))
+    candidates = [step for step in steps.keys() if step <= from_step]
+    if not candidates:
+        raise ValueError('No checkpointed step at or before step {}, earliest is {}'.format(from_step, min(steps.keys())))
+    step = max(candidates)
+
+    meta = dict(saved["meta"])
+    if prompt is not None:
+        meta["prompt"] = prompt
+    if guidance_scale is not None:
+        meta["guidance_scale"] = guidance_scale
+
+    noise_scheduler = steps[step]["scheduler"]
+    state = {"latents": steps[step]["latents"].to(pipe.unet.device), "step": step}
+    state.update(saved["inpaint"])
+    if num_inference_steps is None:
+        num_inference_steps = meta["num_inference_steps"]
+    if scheduler is None:
+        scheduler = meta.get("scheduler", DEFAULT_SCHEDULER)
+    if num_inference_steps != meta["num_inference_steps"] or scheduler != meta.get("scheduler", DEFAULT_SCHEDULER):
+        rescheduled = get_scheduler(pipe, scheduler)
+        state = reschedule(state, noise_scheduler, rescheduled, num_inference_steps)
+        noise_scheduler = rescheduled
+        meta["num_inference_steps"] = num_inference_steps
+        meta["scheduler"] = scheduler
+
+    with torch.no_grad(), autocast("cuda"):
+        img = run_denoise(pipe, noise_scheduler, state, meta, new_checkpoint)
+    if meta.get("region") is not None:
+        # only the region around the mask was diffused
+        image, mask = region_inputs(meta["img_prompt"], meta["img_mask"])
+        img = paste_region(image, mask, img, meta["region"])
+    return img
+
+def save_generation(
+    img: Image.Image,
+    prompt: str,
+    outfile: Optional[str] = None,
+    upscale: Optional[float] = None,
+    fix_faces: bool = False,
+    img_prompt: Optional[str] = None,
+):
+    """Applies the optional upscaling/face restoration to a generated image and persists it"""
+    if upscale is not None or fix_faces:
+      cv_image = pil2opencv(img)
+      if fix_faces:
+        img = gfpgan_image(cv_image, upscale if upscale is not None else 1.0, only_center_face=False, prealligned=False)
+      else:
+        img = real_ersgan_image(cv_image, upscale, for_anime=False)
+
+    if outfile is None:
+        outfile = get_png_filename(prompt)
+    logger.info("Saving Stable Diffusion Image to %s", outfile)
+    with timed('encode_save'):
+        img.save(outfile)
+
+    return add_image_file(trim_path(outfile), prompt, img_prompt, img)
 
 @router.post("/transforms/stable-diffusion")
 def create_stable_diffusion(
@@ -132,7 +318,12 @@ def create_stable_diffusion(
     num_inference_steps: int = 50,
     guidance_scale: float = 7.5,
     eta: float = 0.0,
-    strength: float = 8.0
+    strength: float = 8.0,
+    seed: Optional[int] = None,
+    checkpoint: bool = False,
+    scheduler: str = DEFAULT_SCHEDULER,
+    priority: str = 'interactive',
+    region_inpaint: bool = False,
 ):
     """Runs [Stable Diffusion](https://github.com/CompVis/stable-diffusion) models to generate and save an image
 
@@ -160,32 +351,120 @@ def create_stable_diffusion(
     :type eta: float, optional
     :param strength: Value between 0.0-1.0 that controls the amount of noise that is added to the input image. Values that approach 1.0 will be less semantically consistent with the input image, defaults to 8.0
     :type strength: float, optional
-    :return: path to generated image
-    :rtype: str
+    :param seed: Seed for the initial noise, random if not defined
+    :type seed: Optional[int], optional
+    :param checkpoint: If set to true, keep the intermediate latents so the generation can be refined later
+    :type checkpoint: bool, optional
+    :param scheduler: Sampler used for denoising (default, pndm, ddim or lms). Defaults to the model's own
+    :type scheduler: str, optional
+    :param priority: Priority class of the generation (interactive, normal or bulk), defaults to interactive
+    :type priority: str, optional
+    :param region_inpaint: If set to true when inpainting, only diffuse a window around the mask at native resolution and paste it back, much faster for small masks and works for inputs larger than 512
+    :type region_inpaint: bool, optional
+    :return: path to generated image, along with the seed used and the checkpoint id if checkpointed
+    :rtype: dict
     """
-    add_prompt(prompt, img_prompt)
-    img = stable_diffusion(
-        prompt=prompt,
-        width=width,
-        height=height,
-        img_prompt=img_prompt,
-        img_mask=img_mask,
-        num_inference_steps=num_inference_steps,
-        guidance_scale=guidance_scale,
-        eta=eta,
-        strength=strength,
-    )
+    if scheduler not in SCHEDULER_NAMES:
+        raise HTTPException(status_code=400, detail="Unknown scheduler " + scheduler)
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail="Unknown priority " + priority)
+    prompt_id = add_prompt(prompt, img_prompt)
+    if seed is None:
+        seed = random_seed()
+    checkpoint_id = new_checkpoint_id() if checkpoint else None
+    try:
+        with in_flight('stable_diffusion'), gpu_job(priority):
+            img = stable_diffusion(
+                prompt=prompt,
+                width=width,
+                height=height,
+                img_prompt=img_prompt,
+                img_mask=img_mask,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                eta=eta,
+                strength=strength,
+                seed=seed,
+                checkpoint=checkpoint_id,
+                scheduler=scheduler,
+                region_inpaint=region_inpaint,
+            )
+            res = save_generation(img, prompt, outfile, upscale, fix_faces, img_prompt)
+    except (ValueError, InsufficientMemoryError) as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except QueueFullError as error:
+        raise HTTPException(status_code=503, detail=str(error))
 
-    if upscale is not None or fix_faces:
-      cv_image = pil2opencv(img)
-      if fix_faces:
-        img = gfpgan_image(cv_image, upscale if upscale is not None else 1.0, only_center_face=False, prealligned=False)
-      else:
-        img = real_ersgan_image(cv_image, upscale, for_anime=False)
+    link_prompt_image(prompt_id, res["id"])
+    res["seed"] = seed
+    res["checkpoint"] = checkpoint_id
+    return res
 
-    if outfile is None:
-        outfile = get_png_filename(prompt)
-    print("Saving Stable Diffusion Image to ", outfile)
-    img.save(outfile)
+@router.post("/transforms/stable-diffusion/refine")
+def create_refinement(
+    checkpoint: str,
+    from_step: Optional[int] = None,
+    num_inference_steps: Optional[int] = None,
+    guidance_scale: Optional[float] = None,
+    prompt: Optional[str] = None,
+    outfile: Optional[str] = None,
+    upscale: Optional[float] = None,
+    fix_faces: bool = False,
+    new_checkpoint: bool = False,
+    scheduler: Optional[str] = None,
+    priority: str = 'interactive',
+):
+    """Refines a checkpointed Stable Diffusion generation and saves the result
 
-    return add_image_file(trim_path(outfile), prompt, img_prompt, img)
+    :param checkpoint: Checkpoint id returned when generating with checkpoint set
+    :type checkpoint: str
+    :param from_step: Denoising step to resume from, rounded down to the closest saved step. Defaults to the last intermediate step saved
+    :type from_step: Optional[int], optional
+    :param num_inference_steps: If defined, finish the generation following a schedule of this many steps
+    :type num_inference_steps: Optional[int], optional
+    :param guidance_scale: If defined, overrides the guidance scale of the original generation
+    :type guidance_scale: Optional[float], optional
+    :param prompt: If defined, overrides the prompt of the original generation
+    :type prompt: Optional[str], optional
+    :param outfile: If defined, persist to that path, otherwise create new file path
+    :type persist: Optional[str], optional
+    :param upscale: If defined, use Real-ERSGAN model for upscaling the output by the factor provided
+    :type upscale: float, optional
+    :param fix_faces: If set to true, use GFPGAN model for face restoration
+    :param fix_faces: bool, optional
+    :param new_checkpoint: If set to true, checkpoint the refined generation as well
+    :type new_checkpoint: bool, optional
+    :param scheduler: If defined, finish the generation with this sampler instead of the original one
+    :type scheduler: Optional[str], optional
+    :param priority: Priority class of the refinement (interactive, normal or bulk), defaults to interactive
+    :type priority: str, optional
+    :return: path to generated image, along with the checkpoint id if checkpointed
+    :rtype: dict
+    """
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail="Unknown priority " + priority)
+    prompt_id = None if prompt is None else add_prompt(prompt)
+    checkpoint_id = new_checkpoint_id() if new_checkpoint else None
+    try:
+        with in_flight('stable_diffusion'), gpu_job(priority):
+            img = refine(
+                checkpoint,
+                from_step=from_step,
+                num_inference_steps=num_inference_steps,
+                guidance_scale=guidance_scale,
+                prompt=prompt,
+                new_checkpoint=checkpoint_id,
+                scheduler=scheduler,
+            )
+            res = save_generation(img, prompt or "Refinement of " + checkpoint, outfile, upscale, fix_faces)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Unknown or evicted checkpoint " + checkpoint)
+    except (ValueError, InsufficientMemoryError) as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except QueueFullError as error:
+        raise HTTPException(status_code=503, detail=str(error))
+
+    if prompt_id is not None:
+        link_prompt_image(prompt_id, res["id"])
+    res["checkpoint"] = checkpoint_id
+    return res
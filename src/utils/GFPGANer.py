@@ -1,8 +1,12 @@
 # lightly modified from https://github.com/TencentARC/GFPGAN/blob/master/gfpgan/utils.py
 
 import cv2
+import hashlib
+import numpy as np
 import os
+import threading
 import torch
+from collections import OrderedDict
 from basicsr.utils import img2tensor, tensor2img
 from basicsr.utils.download_util import load_file_from_url
 from facexlib.utils.face_restoration_helper import FaceRestoreHelper
@@ -12,8 +16,18 @@ from gfpgan.archs.gfpgan_bilinear_arch import GFPGANBilinear
 from gfpgan.archs.gfpganv1_arch import GFPGANv1
 from gfpgan.archs.gfpganv1_clean_arch import GFPGANv1Clean
 
+from utils.gpu_queue import no_preemption
+from utils.metrics import logger, timed
+
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# Face detection runs on a copy of the image downscaled to at most this size, landmarks are mapped back to full size
+DETECTION_MAX_SIZE = int(os.getenv('FACE_DETECTION_MAX_SIZE', '1024'))
+# Number of images whose face detections are kept, so re-processing an image skips detection
+DETECTION_CACHE_SIZE = int(os.getenv('FACE_DETECTION_CACHE_SIZE', '64'))
+# Value FaceRestoreHelper.align_warp_face fills the area outside of the image with
+WARP_BORDER_VALUE = (135, 133, 132)
+
 
 class GFPGANer():
     """Helper for restoration with GFPGAN.
@@ -21,17 +35,22 @@ class GFPGANer():
     GFPGAN is used to restored the resized faces.
     The background is upsampled with the bg_upsampler.
     Finally, the faces will be pasted back to the upsample background image.
+    The networks are loaded once, the upscale and background upsampler can be overridden on every call to enhance.
     Args:
         model_path (str): The path to the GFPGAN model. It can be urls (will first download it automatically).
-        upscale (float): The upscale of the final output. Default: 2.
+        upscale (float): The default upscale of the final output. Default: 2.
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
-        bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        bg_upsampler (nn.Module): The default upsampler for the background. Default: None.
     """
 
     def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        # image content hash -> {'bboxes': full size detections, 'affine_matrices': {only_center_face: matrices}}
+        self.detection_cache = OrderedDict()
+        # the face helper holds the state of the image being processed, so one image is processed at a time
+        self.lock = threading.Lock()
 
         # initialize model
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
@@ -88,7 +107,7 @@ class GFPGANer():
         if model_path.startswith('https://'):
             model_path = load_file_from_url(
                 url=model_path, model_dir=model_rootpath, progress=True, file_name=None)
-        print('attempting to load', model_path)
+        logger.info('Loading GFPGAN model %s', model_path)
         loadnet = torch.load(model_path)
         if 'params_ema' in loadnet:
             keyname = 'params_ema'
@@ -98,21 +117,96 @@ class GFPGANer():
         self.gfpgan.eval()
         self.gfpgan = self.gfpgan.to(self.device)
 
+    def detect_faces(self, img):
+        """Detects faces with RetinaFace on a copy of img downscaled to DETECTION_MAX_SIZE, cached by image content.
+        Returns the cache entry, whose 'bboxes' are rows of (x1, y1, x2, y2, score, 5 landmark x/y pairs) in img coordinates"""
+        key = hashlib.sha1(np.ascontiguousarray(img).data).hexdigest() + str(img.shape)
+        if key in self.detection_cache:
+            self.detection_cache.move_to_end(key)
+            return self.detection_cache[key]
+
+        height, width = img.shape[0:2]
+        scale = min(1.0, DETECTION_MAX_SIZE / max(height, width))
+        if scale < 1.0:
+            img = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+        with torch.no_grad():
+            bboxes = np.array(self.face_helper.face_det.detect_faces(img, 0.97), dtype=np.float32).reshape(-1, 15)
+        # everything but the score is a coordinate
+        bboxes[:, 0:4] /= scale
+        bboxes[:, 5:15] /= scale
+
+        detection = {'bboxes': bboxes, 'affine_matrices': {}}
+        self.detection_cache[key] = detection
+        while len(self.detection_cache) > DETECTION_CACHE_SIZE:
+            self.detection_cache.popitem(last=False)
+        return detection
+
+    def set_face_landmarks_5(self, bboxes, only_center_face=False, eye_dist_threshold=None):
+        """Same as FaceRestoreHelper.get_face_landmarks_5, but from detections made by detect_faces"""
+        for bbox in bboxes:
+            eye_dist = np.linalg.norm([bbox[5] - bbox[7], bbox[6] - bbox[8]])
+            if eye_dist_threshold is not None and eye_dist < eye_dist_threshold:
+                continue
+            self.face_helper.all_landmarks_5.append(np.array([[bbox[i], bbox[i + 1]] for i in range(5, 15, 2)]))
+            self.face_helper.det_faces.append(bbox[0:5])
+        if only_center_face and len(self.face_helper.det_faces) > 0:
+            height, width = self.face_helper.input_img.shape[0:2]
+            center = np.array([width / 2, height / 2])
+            center_idx = int(np.argmin([
+                np.linalg.norm(np.array([(face[0] + face[2]) / 2, (face[1] + face[3]) / 2]) - center)
+                for face in self.face_helper.det_faces]))
+            self.face_helper.det_faces = [self.face_helper.det_faces[center_idx]]
+            self.face_helper.all_landmarks_5 = [self.face_helper.all_landmarks_5[center_idx]]
+        return len(self.face_helper.all_landmarks_5)
+
+    def warp_faces(self, affine_matrices):
+        """Same as FaceRestoreHelper.align_warp_face, with affine matrices already computed for this image"""
+        for affine_matrix in affine_matrices:
+            self.face_helper.affine_matrices.append(affine_matrix)
+            cropped_face = cv2.warpAffine(
+                self.face_helper.input_img,
+                affine_matrix,
+                self.face_helper.face_size,
+                borderMode=cv2.BORDER_CONSTANT,
+                borderValue=WARP_BORDER_VALUE)
+            self.face_helper.cropped_faces.append(cropped_face)
+
+    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, upscale=None, bg_upsampler=None):
+        """Restores the faces in img, upscaling the result by upscale with bg_upsampler for the background.
+        upscale and bg_upsampler default to the ones given to the constructor"""
+        # other jobs may be waiting on the lock, so the job holding it must not give the device up
+        with self.lock, no_preemption():
+            return self.enhance_locked(
+                img,
+                has_aligned,
+                only_center_face,
+                paste_back,
+                self.upscale if upscale is None else upscale,
+                self.bg_upsampler if bg_upsampler is None else bg_upsampler)
+
     @torch.no_grad()
-    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True):
+    def enhance_locked(self, img, has_aligned, only_center_face, paste_back, upscale, bg_upsampler):
         self.face_helper.clean_all()
+        # only used when pasting the faces back, so it can change from one image to the next
+        self.face_helper.upscale_factor = upscale
 
         if has_aligned:  # the inputs are already aligned
             img = cv2.resize(img, (512, 512))
             self.face_helper.cropped_faces = [img]
         else:
-            self.face_helper.read_image(img)
-            # get face landmarks for each face
-            self.face_helper.get_face_landmarks_5(only_center_face=only_center_face, eye_dist_threshold=5)
-            # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
-            # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
-            # align and warp each face
-            self.face_helper.align_warp_face()
+            with timed('gfpgan.face_detection'):
+                self.face_helper.read_image(img)
+                detection = self.detect_faces(self.face_helper.input_img)
+                # get face landmarks for each face
+                # eye_dist_threshold=5: skip faces whose eye distance is smaller than 5 pixels
+                # TODO: even with eye_dist_threshold, it will still introduce wrong detections and restorations.
+                self.set_face_landmarks_5(detection['bboxes'], only_center_face=only_center_face, eye_dist_threshold=5)
+                # align and warp each face, reusing the affine matrices if this image was aligned before
+                if only_center_face in detection['affine_matrices']:
+                    self.warp_faces(detection['affine_matrices'][only_center_face])
+                else:
+                    self.face_helper.align_warp_face()
+                    detection['affine_matrices'][only_center_face] = list(self.face_helper.affine_matrices)
 
         # face restoration
         for cropped_face in self.face_helper.cropped_faces:
@@ -126,7 +220,7 @@ class GFPGANer():
                 # convert to image
                 restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
             except RuntimeError as error:
-                print(f'\tFailed inference for GFPGAN: {error}.')
+                logger.warning('Failed inference for GFPGAN: %s', error)
                 restored_face = cropped_face
 
             restored_face = restored_face.astype('uint8')
@@ -134,15 +228,17 @@ class GFPGANer():
 
         if not has_aligned and paste_back:
             # upsample the background
-            if self.bg_upsampler is not None:
+            if bg_upsampler is not None:
                 # Now only support RealESRGAN for upsampling background
-                bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
+                with timed('gfpgan.background_upsample'):
+                    bg_img = bg_upsampler.enhance(img, outscale=upscale)[0]
             else:
                 bg_img = None
 
-            self.face_helper.get_inverse_affine(None)
-            # paste each restored face to the input image
-            restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
+            with timed('gfpgan.paste_back'):
+                self.face_helper.get_inverse_affine(None)
+                # paste each restored face to the input image
+                restored_img = self.face_helper.paste_faces_to_input_image(upsample_img=bg_img)
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
\ No newline at end of file
@@ -1,10 +1,26 @@
+import re
 import sqlite3
 import os
+import time as clock
 
 from PIL import Image
 from typing import Optional
 from utils.file_utils import DB_PATH, UPLOAD_DIRNAME, OUTPUT_DIRNAME, ROOT_DIR
+from utils.images import image_size
+from utils.metrics import logger, timed
 IMAGE_COLS = ["id", "src", "alt", "width", "height", "isUpload", "time", "referenceImage"]
+PROMPT_COLS = ["id", "prompt", "uses", "lastUsed"]
+
+# Prompt searches rank at most this many of the most used matches, keeping them fast on very large histories
+PROMPT_SEARCH_CANDIDATES = int(os.getenv('PROMPT_SEARCH_CANDIDATES', '200'))
+# Prompts are indexed under uses * RANK_KEY_STRIDE + the history id of their last use, so that the order of the
+# full-text index (by rowid) is most used first, then most recently used first
+RANK_KEY_STRIDE = 2 ** 32
+# BM25 parameters of the search ranking
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Words as the full-text index tokenizes them (unicode61 splits on anything but letters and digits)
+WORD = re.compile(r'[^\W_]+')
 
 def init_db():
   with sqlite3.connect(DB_PATH) as cur:
@@ -24,17 +40,64 @@ def init_db():
       prompt text,
       reference_image integer
     )""")
+    cur.execute("CREATE INDEX IF NOT EXISTS images_src ON images (src)")
+
+    # distinct prompts with their usage, full-text indexed for search and autocomplete
+    cur.execute("""CREATE TABLE IF NOT EXISTS prompts (
+      id integer primary key,
+      prompt text unique,
+      uses integer,
+      last_used real,
+      rank_key integer
+    )""")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS prompts_rank_key ON prompts (rank_key)")
+    cur.execute("CREATE INDEX IF NOT EXISTS prompts_last_used ON prompts (last_used)")
+    # only single words are looked up, so the index keeps no positions (detail=none), and every prefix length
+    # autocomplete is likely to see is indexed, as longer prefixes merge the lists of every word they start
+    cur.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(
+      prompt,
+      content='prompts',
+      content_rowid='rank_key',
+      detail=none,
+      prefix='1 2 3 4 5 6 7 8 9 10'
+    )""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS prompts_fts_insert AFTER INSERT ON prompts BEGIN
+      INSERT INTO prompts_fts (rowid, prompt) VALUES (new.rank_key, new.prompt);
+    END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS prompts_fts_update AFTER UPDATE OF rank_key ON prompts BEGIN
+      INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.rank_key, old.prompt);
+      INSERT INTO prompts_fts (rowid, prompt) VALUES (new.rank_key, new.prompt);
+    END""")
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS prompts_fts_delete AFTER DELETE ON prompts BEGIN
+      INSERT INTO prompts_fts (prompts_fts, rowid, prompt) VALUES ('delete', old.rank_key, old.prompt);
+    END""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS prompt_images (
+      prompt_id integer,
+      image_id integer,
+      primary key (prompt_id, image_id)
+    )""")
 
+    # prompts used before the prompts table existed only live in the history
+    if cur.execute("SELECT 1 FROM prompts LIMIT 1").fetchone() is None:
+      backfilled = cur.execute("""INSERT INTO prompts (prompt, uses, last_used, rank_key)
+        SELECT prompt, count(*), 0, count(*) * ? + max(id) FROM history GROUP BY prompt
+      """, (RANK_KEY_STRIDE,)).rowcount > 0
+      if backfilled:
+        # bulk loads leave the index split in many segments, which are several times slower to query
+        cur.execute("INSERT INTO prompts_fts (prompts_fts) VALUES ('optimize')")
+
+@timed('db.add_image')
 def add_image(path: str, alt: str, width: int, height: int, time: float, reference_image: int = -1):
   
   with sqlite3.connect(DB_PATH) as cur:
     is_upload = 1 if path.startswith(UPLOAD_DIRNAME) else 0
-    cur.execute("""INSERT INTO 
+    res = cur.execute("""INSERT INTO 
       images(src, alt, width, height, is_upload, time, reference_image)
       VALUES (?,?,?,?,?, ?, ?)""", 
       (path, alt, width, height, is_upload, time, reference_image)
     )
   return {
+    "id": res.lastrowid,
     "src": path,
     "alt": alt,
     "width": width,
@@ -44,28 +107,28 @@ def add_image(path: str, alt: str, width: int, height: int, time: float, referen
     "reference_image": reference_image
   }
 
+@timed('db.add_image_file')
 def add_image_file(path: str, alt: str = "", reference_image_path: Optional[str] = None, loaded_image: Optional[Image.Image] = None):
   
   if path.startswith(ROOT_DIR):
     path = path[len(ROOT_DIR):]
   full_path = ROOT_DIR + path
-  if loaded_image is None:
-    loaded_image = Image.open(full_path)
+  width, height = image_size(full_path) if loaded_image is None else loaded_image.size
   reference_image = -1
   if reference_image_path is not None:
 
     with sqlite3.connect(DB_PATH) as cur:
-      res = cur.execute("SELECT id FROM images WHERE path = ?", (reference_image_path))
+      res = cur.execute("SELECT id FROM images WHERE src = ?", (reference_image_path,))
       row = res.fetchone()
       reference_image = row[0] if row is not None else -1
   time = os.path.getmtime(full_path)
-  return add_image(path, alt, loaded_image.width, loaded_image.height, time, reference_image)
+  return add_image(path, alt, width, height, time, reference_image)
 
 def add_all_images(dir: str, alt: str):
   """For adding images in bulk to the DB"""
   for root, dirs, files in os.walk(dir):
     for name in files:
-      print("Adding ", name)
+      logger.info("Adding %s", name)
       add_image_file(os.path.join(root, name), alt)
 
 def get_image_row_dict(row):
@@ -74,6 +137,7 @@ def get_image_row_dict(row):
     res[key] = row[index]
   return res
 
+@timed('db.get_images')
 def get_images(is_upload: Optional[bool] = None):
   with sqlite3.connect(DB_PATH) as cur:
     query = "SELECT * from images WHERE is_upload = 1 ORDER BY time DESC"
@@ -89,6 +153,7 @@ def get_images(is_upload: Optional[bool] = None):
       return []
     return [get_image_row_dict(row) for row in rows]
 
+@timed('db.delete_image')
 def delete_image(path: str):
   
   if path.startswith(ROOT_DIR):
@@ -96,22 +161,121 @@ def delete_image(path: str):
   full_path = ROOT_DIR + path
   with sqlite3.connect(DB_PATH) as cur:
     cur.execute("DELETE FROM files WHERE path = ?", path)
-  print('Deleting file', filepath)
+  logger.info('Deleting file %s', full_path)
   os.remove(path)
 
+@timed('db.add_prompt')
 def add_prompt(prompt: str, reference_image_path: Optional[str] = None):
+  """Records a use of prompt, returning the id of the prompt (shared by every use of the same prompt)"""
 
   with sqlite3.connect(DB_PATH) as cur:
     reference_image = -1
     if reference_image_path is not None:
-      res = cur.execute("SELECT id FROM images WHERE path = ?", (reference_image_path))
+      res = cur.execute("SELECT id FROM images WHERE src = ?", (reference_image_path,))
       row = res.fetchone()
       reference_image = row[0] if row is not None else -1
-    cur.execute("""INSERT INTO 
+    history_id = cur.execute("""INSERT INTO 
       history (prompt, reference_image)
       VALUES (?, ?)
-    """, (prompt, reference_image))
+    """, (prompt, reference_image)).lastrowid
+    cur.execute("""INSERT INTO prompts (prompt, uses, last_used, rank_key) VALUES (?, 1, ?, ?)
+      ON CONFLICT (prompt) DO UPDATE SET
+        uses = uses + 1,
+        last_used = excluded.last_used,
+        rank_key = (uses + 1) * ? + ?
+    """, (prompt, clock.time(), RANK_KEY_STRIDE + history_id, RANK_KEY_STRIDE, history_id))
+    return cur.execute("SELECT id FROM prompts WHERE prompt = ?", (prompt,)).fetchone()[0]
+
+@timed('db.link_prompt_image')
+def link_prompt_image(prompt_id: int, image_id: int):
+  """Records that image was generated from prompt"""
+  with sqlite3.connect(DB_PATH) as cur:
+    cur.execute("INSERT OR IGNORE INTO prompt_images (prompt_id, image_id) VALUES (?, ?)", (prompt_id, image_id))
+
+def prompt_words(text: str):
+  """Words of text as the full-text index tokenizes them"""
+  return WORD.findall(text.lower())
+
+def prompt_match_query(text: str, prefix: bool):
+  """FTS5 query matching every word of text, the last one as a prefix if prefix. None if text has no words"""
+  words = prompt_words(text)
+  if not words:
+    return None
+  terms = ['"{}"'.format(word) for word in words]
+  if prefix:
+    terms[-1] += '*'
+  return ' '.join(terms)
+
+def get_prompt_rows(cur, rows):
+  prompts = [dict(zip(PROMPT_COLS, row)) for row in rows]
+  if not prompts:
+    return prompts
+  by_id = {prompt["id"]: prompt for prompt in prompts}
+  for prompt in prompts:
+    prompt["images"] = []
+  res = cur.execute("""SELECT prompt_images.prompt_id, images.src
+    FROM prompt_images JOIN images ON images.id = prompt_images.image_id
+    WHERE prompt_images.prompt_id IN ({})
+    ORDER BY images.time DESC""".format(','.join('?' * len(by_id))), list(by_id.keys()))
+  for prompt_id, src in res.fetchall():
+    by_id[prompt_id]["images"].append(src)
+  return prompts
 
+def recent_prompts(cur, limit: int):
+  res = cur.execute("SELECT id, prompt, uses, last_used FROM prompts ORDER BY last_used DESC LIMIT ?", (limit,))
+  return get_prompt_rows(cur, res.fetchall())
 
+@timed('db.autocomplete_prompts')
+def autocomplete_prompts(prefix: str, limit: int = 10):
+  """Previously used prompts containing every word of prefix, the last one possibly incomplete, most used first.
+  The most recently used prompts if prefix has no words"""
+  match = prompt_match_query(prefix, True)
+  with sqlite3.connect(DB_PATH) as cur:
+    if match is None:
+      return recent_prompts(cur, limit)
+    # the index is in rank key order, so this stops at the first limit matches
+    res = cur.execute("""SELECT prompts.id, prompts.prompt, prompts.uses, prompts.last_used
+      FROM prompts_fts JOIN prompts ON prompts.rank_key = prompts_fts.rowid
+      WHERE prompts_fts MATCH ?
+      ORDER BY prompts_fts.rowid DESC
+      LIMIT ?""", (match, limit))
+    return get_prompt_rows(cur, res.fetchall())
+
+def relevance(words: list, prompts: list):
+  """BM25 scores of each prompt for the query words.
 
+  Every prompt contains every word, so the inverse document frequencies BM25 weights words with would only matter
+  for repeated words, and are left out: FTS5 can only compute them by scanning every match of every word"""
+  tokens = [prompt_words(prompt) for prompt in prompts]
+  lengths = [len(prompt_tokens) for prompt_tokens in tokens]
+  average_length = sum(lengths) / len(lengths)
+  scores = []
+  for prompt_tokens, length in zip(tokens, lengths):
+    length_norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+    score = 0.0
+    for word in words:
+      frequency = prompt_tokens.count(word)
+      score += frequency * (BM25_K1 + 1) / (frequency + length_norm)
+    scores.append(score)
+  return scores
 
+@timed('db.search_prompts')
+def search_prompts(text: str, limit: int = 20):
+  """Previously used prompts containing every word of text, best match (BM25) first among the
+  PROMPT_SEARCH_CANDIDATES most used matches, then most used first. The most recently used prompts if text has no words"""
+  match = prompt_match_query(text, False)
+  with sqlite3.connect(DB_PATH) as cur:
+    if match is None:
+      return recent_prompts(cur, limit)
+    rows = cur.execute("""SELECT prompts.id, prompts.prompt, prompts.uses, prompts.last_used
+      FROM (
+        SELECT rowid FROM prompts_fts WHERE prompts_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+      ) AS matches
+      JOIN prompts ON prompts.rank_key = matches.rowid
+      ORDER BY matches.rowid DESC""", (match, PROMPT_SEARCH_CANDIDATES)).fetchall()
+    if not rows:
+      return []
+    scores = relevance(prompt_words(text), [row[1] for row in rows])
+    # sorting is stable, so equally relevant prompts stay most used first
+    ranked = sorted(range(len(rows)), key=lambda index: -scores[index])[:limit]
+    return get_prompt_rows(cur, [rows[index] for index in ranked])
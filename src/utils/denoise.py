@@ -0,0 +1,238 @@
+# Stable Diffusion denoising loop, following the diffusers 0.3.0 pipelines but run step by step
+# so that a generation can be checkpointed, resumed from an intermediate step and refined
+
+import copy
+import inspect
+import os
+from typing import Union
+
+import numpy
+import torch
+from diffusers import LMSDiscreteScheduler
+from PIL import Image
+
+# Scaling applied by Stable Diffusion between the VAE latent space and the UNet latent space
+LATENT_SCALE = 0.18215
+
+# Size in latents (8 pixels each) of the tiles used by tiled VAE decoding, and how much neighbouring tiles overlap
+VAE_TILE_SIZE = int(os.getenv('VAE_TILE_SIZE', '64'))
+VAE_TILE_OVERLAP = int(os.getenv('VAE_TILE_OVERLAP', '8'))
+
+def is_lms(scheduler):
+  return isinstance(scheduler, LMSDiscreteScheduler)
+
+def fresh_scheduler(pipe):
+  """Schedulers keep per-generation state, so every generation gets its own copy"""
+  return copy.deepcopy(pipe.scheduler)
+
+def set_timesteps(scheduler, num_inference_steps: int):
+  """Sets up the scheduler for num_inference_steps, returning the timestep offset used"""
+  if 'offset' in inspect.signature(scheduler.set_timesteps).parameters:
+    scheduler.set_timesteps(num_inference_steps, offset=1)
+    return 1
+  scheduler.set_timesteps(num_inference_steps)
+  return 0
+
+def scheduler_timestep(scheduler, index: int):
+  """The value passed to scheduler.step/add_noise at loop index `index` (LMS works with indices)"""
+  return index if is_lms(scheduler) else scheduler.timesteps[index]
+
+def encode_prompt(pipe, prompt: str, guidance_scale: float):
+  """Text embeddings for the prompt, preceded by the unconditional embeddings when using guidance"""
+  device = pipe.unet.device
+  text_input = pipe.tokenizer(
+    prompt,
+    padding='max_length',
+    max_length=pipe.tokenizer.model_max_length,
+    truncation=True,
+    return_tensors='pt')
+  text_embeddings = pipe.text_encoder(text_input.input_ids.to(device))[0]
+  if guidance_scale <= 1.0:
+    return text_embeddings
+  uncond_input = pipe.tokenizer(
+    [''],
+    padding='max_length',
+    max_length=text_input.input_ids.shape[-1],
+    return_tensors='pt')
+  uncond_embeddings = pipe.text_encoder(uncond_input.input_ids.to(device))[0]
+  return torch.cat([uncond_embeddings, text_embeddings])
+
+def preprocess_image(image: Union[Image.Image, numpy.ndarray]):
+  """Model input of an RGB PIL.Image or uint8 array, cropped by resizing to multiples of 32 pixels
+
+  Arrays already the right size are converted without any intermediate copy, so cached read-only arrays are fine
+  """
+  if isinstance(image, numpy.ndarray):
+    height, width = image.shape[:2]
+    if width % 32 == 0 and height % 32 == 0:
+      return 2.0 * torch.from_numpy(image.astype(numpy.float32)[None].transpose(0, 3, 1, 2) / 255.0) - 1.0
+    image = Image.fromarray(image)
+  width, height = map(lambda x: x - x % 32, image.size)
+  image = image.resize((width, height), resample=Image.LANCZOS)
+  image = numpy.array(image).astype(numpy.float32) / 255.0
+  image = image[None].transpose(0, 3, 1, 2)
+  return 2.0 * torch.from_numpy(image) - 1.0
+
+def preprocess_mask(mask: Image.Image):
+  mask = mask.convert('L')
+  width, height = map(lambda x: x - x % 32, mask.size)
+  mask = mask.resize((width // 8, height // 8), resample=Image.NEAREST)
+  mask = numpy.array(mask).astype(numpy.float32) / 255.0
+  mask = numpy.tile(mask, (4, 1, 1))[None]
+  # white pixels are repainted, so the mask marks the latents to keep
+  return torch.from_numpy(1 - mask)
+
+def start_txt2img(pipe, scheduler, width: int, height: int, num_inference_steps: int, generator):
+  """Initial denoising state for a text-to-image generation
+
+  The state is a dict holding the current "latents" and the loop index of the next "step",
+  plus the original latents, noise and mask for inpainting.
+  """
+  set_timesteps(scheduler, num_inference_steps)
+  latents = torch.randn(
+    (1, pipe.unet.in_channels, height // 8, width // 8),
+    generator=generator,
+    device=pipe.unet.device)
+  if is_lms(scheduler):
+    latents = latents * scheduler.sigmas[0]
+  return {"latents": latents, "step": 0}
+
+def start_img2img(
+  pipe,
+  scheduler,
+  init_image: Union[Image.Image, numpy.ndarray],
+  strength: float,
+  num_inference_steps: int,
+  generator,
+  mask_image: Image.Image = None,
+):
+  """Initial denoising state for an image-to-image generation, or an inpainting if mask_image is given"""
+  device = pipe.unet.device
+  offset = set_timesteps(scheduler, num_inference_steps)
+  init_latents = pipe.vae.encode(preprocess_image(init_image).to(device)).latent_dist.sample(generator=generator)
+  init_latents = LATENT_SCALE * init_latents
+
+  init_timestep = min(int(num_inference_steps * strength) + offset, num_inference_steps)
+  if is_lms(scheduler):
+    timesteps = torch.tensor([num_inference_steps - init_timestep], dtype=torch.long)
+  else:
+    timesteps = torch.tensor([scheduler.timesteps[-init_timestep]], dtype=torch.long)
+  noise = torch.randn(init_latents.shape, generator=generator, device=device)
+
+  state = {
+    "latents": scheduler.add_noise(init_latents, noise, timesteps).to(device),
+    "step": max(num_inference_steps - init_timestep + offset, 0),
+  }
+  if mask_image is not None:
+    state["init_latents"] = init_latents
+    state["noise"] = noise
+    state["mask"] = preprocess_mask(mask_image).to(device)
+  return state
+
+def reschedule(state: dict, old_scheduler, new_scheduler, num_inference_steps: int):
+  """Moves a denoising state onto a new schedule, starting at the first step no noisier than the current one"""
+  if state["step"] >= len(old_scheduler.timesteps):
+    return dict(state)
+  timestep = old_scheduler.timesteps[state["step"]]
+  latents = state["latents"]
+  # LMS latents carry noise scaled by sigma, the other schedulers keep them unit variance
+  if is_lms(old_scheduler):
+    latents = latents / ((old_scheduler.sigmas[state["step"]] ** 2 + 1) ** 0.5)
+
+  set_timesteps(new_scheduler, num_inference_steps)
+  step = next(
+    (index for index, t in enumerate(new_scheduler.timesteps) if t <= timestep),
+    len(new_scheduler.timesteps))
+  if is_lms(new_scheduler) and step < len(new_scheduler.timesteps):
+    latents = latents * ((new_scheduler.sigmas[step] ** 2 + 1) ** 0.5)
+  return {**state, "latents": latents, "step": step}
+
+def denoise(pipe, scheduler, state: dict, text_embeddings, guidance_scale: float, eta: float = 0.0, on_step=None):
+  """Runs the remaining denoising steps of a state
+
+  :param pipe: Stable Diffusion pipeline providing the unet
+  :param scheduler: Scheduler the state was started with
+  :param state: dict from start_txt2img/start_img2img/reschedule
+  :param text_embeddings: Output of encode_prompt
+  :param guidance_scale: Classifier free guidance scale, must match the one passed to encode_prompt
+  :param eta: DDIM eta, ignored by schedulers that do not support it
+  :param on_step: Called as on_step(index, latents, scheduler) before every step and once more after the last one
+  :return: The denoised latents
+  """
+  extra_step_kwargs = {}
+  if 'eta' in inspect.signature(scheduler.step).parameters:
+    extra_step_kwargs['eta'] = eta
+  do_guidance = guidance_scale > 1.0
+
+  latents = state["latents"]
+  for index in range(state["step"], len(scheduler.timesteps)):
+    if on_step is not None:
+      on_step(index, latents, scheduler)
+    timestep = scheduler.timesteps[index]
+
+    latent_model_input = torch.cat([latents] * 2) if do_guidance else latents
+    if is_lms(scheduler):
+      latent_model_input = latent_model_input / ((scheduler.sigmas[index] ** 2 + 1) ** 0.5)
+    noise_pred = pipe.unet(latent_model_input, timestep, encoder_hidden_states=text_embeddings).sample
+    if do_guidance:
+      noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+      noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+    latents = scheduler.step(noise_pred, scheduler_timestep(scheduler, index), latents, **extra_step_kwargs).prev_sample
+
+    if "mask" in state:
+      init_latents_proper = scheduler.add_noise(
+        state["init_latents"],
+        state["noise"],
+        torch.tensor([scheduler_timestep(scheduler, index)], dtype=torch.long))
+      latents = init_latents_proper * state["mask"] + latents * (1 - state["mask"])
+
+  if on_step is not None:
+    on_step(len(scheduler.timesteps), latents, scheduler)
+  return latents
+
+def tile_starts(length: int, tile: int, overlap: int):
+  if length <= tile:
+    return [0]
+  return list(range(0, length - tile, tile - overlap)) + [length - tile]
+
+def blend_ramp(size: int, overlap: int, fade_start: bool, fade_end: bool, device):
+  ramp = torch.ones(size, device=device)
+  fade = torch.linspace(0, 1, overlap + 2, device=device)[1:-1]
+  if fade_start:
+    ramp[:overlap] = fade
+  if fade_end:
+    ramp[-overlap:] = fade.flip(0)
+  return ramp
+
+def decode_tiled(pipe, latents, tile: int = VAE_TILE_SIZE, overlap: int = VAE_TILE_OVERLAP):
+  """Decodes latents one tile at a time, blending the overlaps, so that VAE memory use is bounded by the tile size"""
+  _, _, height, width = latents.shape
+  device = latents.device
+  image = torch.zeros((latents.shape[0], 3, height * 8, width * 8), device=device)
+  weights = torch.zeros((height * 8, width * 8), device=device)
+  for y in tile_starts(height, tile, overlap):
+    for x in tile_starts(width, tile, overlap):
+      decoded = pipe.vae.decode(latents[:, :, y:y + tile, x:x + tile] / LATENT_SCALE).sample.float()
+      tile_height, tile_width = decoded.shape[2:]
+      weight = torch.outer(
+        blend_ramp(tile_height, overlap * 8, y > 0, y + tile < height, device),
+        blend_ramp(tile_width, overlap * 8, x > 0, x + tile < width, device))
+      image[:, :, y * 8:y * 8 + tile_height, x * 8:x * 8 + tile_width] += decoded * weight
+      weights[y * 8:y * 8 + tile_height, x * 8:x * 8 + tile_width] += weight
+  return image / weights
+
+def decode(pipe, latents, tiled: bool = False):
+  """Decodes latents into a PIL image, running the pipeline's safety checker
+
+  :param tiled: If true, decode tile by tile (see decode_tiled) for images too large to decode at once
+  """
+  if tiled:
+    image = decode_tiled(pipe, latents)
+  else:
+    image = pipe.vae.decode(latents / LATENT_SCALE).sample
+  image = (image / 2 + 0.5).clamp(0, 1)
+  image = image.cpu().permute(0, 2, 3, 1).numpy()
+  safety_checker_input = pipe.feature_extractor(pipe.numpy_to_pil(image), return_tensors='pt').to(pipe.unet.device)
+  image, _ = pipe.safety_checker(images=image, clip_input=safety_checker_input.pixel_values)
+  return pipe.numpy_to_pil(image)[0]
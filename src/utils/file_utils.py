@@ -2,10 +2,13 @@ import os
 import requests
 import shutil
 
+from utils.metrics import logger, timed
+
 CACHE_DIR = os.getenv('CACHE_DIR', '/cache')
 
-ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__))))
-print("Running at", ROOT_DIR)
+# Directory holding the output and upload directories, image paths are stored relative to it
+ROOT_DIR = os.getenv('ROOT_DIR', os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(__file__)))))
+logger.info("Running at %s", ROOT_DIR)
 OUTPUT_DIRNAME = 'output'
 OUTPUT_DIR = os.path.join(ROOT_DIR, OUTPUT_DIRNAME)
 UPLOAD_DIRNAME = 'uploads'
@@ -46,9 +49,9 @@ def cache_remote_file(url: str, filename: str):
   :rtype: _type_
   """
   path_to_file = os.path.join(CACHE_DIR, filename)
-  print('Caching to', path_to_file)
   if not os.path.exists(path_to_file):
-    with requests.get(url, stream=True) as response:
+    logger.info('Downloading %s to %s', url, path_to_file)
+    with timed('model_download'), requests.get(url, stream=True) as response:
       with open(path_to_file, 'wb') as local_file:
         shutil.copyfileobj(response.raw, local_file)
   
@@ -0,0 +1,173 @@
+import os
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from utils.metrics import PREEMPTIONS, QUEUE_WAIT_SECONDS, logger
+
+# Priority classes, highest first. Work of a class only runs on the device while no higher class has work
+PRIORITIES = ['interactive', 'normal', 'bulk']
+DEFAULT_PRIORITY = 'normal'
+
+# Maximum number of jobs of each class sharing the device at once
+CONCURRENCY_LIMITS = {
+  'interactive': int(os.getenv('INTERACTIVE_CONCURRENCY', '2')),
+  'normal': int(os.getenv('NORMAL_CONCURRENCY', '1')),
+  'bulk': int(os.getenv('BULK_CONCURRENCY', '1')),
+}
+
+# Maximum number of jobs of each class admitted at once, running, queued or parked by preemption, None for no limit.
+# Every admitted job holds a server worker thread while it waits, so that queued background work cannot take all
+# of them from the interactive requests it yields the device to
+QUEUE_LIMITS = {
+  'interactive': None,
+  'normal': int(os.getenv('NORMAL_QUEUE_LIMIT', '8')),
+  'bulk': int(os.getenv('BULK_QUEUE_LIMIT', '4')),
+}
+
+# Priority of the job running in the current context, None outside of gpu_job
+current_job: ContextVar = ContextVar('current_job', default=None)
+# Set while the current job holds a lock other jobs may need, during which it must keep the device
+preemption_suppressed: ContextVar = ContextVar('preemption_suppressed', default=False)
+# Context managers the current job is parked within when preempted, see while_parked
+parking_hooks: ContextVar = ContextVar('parking_hooks', default=())
+
+class QueueFullError(Exception):
+  """Raised when a job cannot be admitted because too many of its priority class are running or queued"""
+  pass
+
+class GpuArbiter:
+  """Admits jobs to the device by priority class, within each class' concurrency limit.
+
+  Jobs give the device up at their preemption points (denoising steps, upscaling tiles) whenever higher
+  priority work is waiting or running, and resume once it is done.
+  """
+
+  def __init__(self, limits: dict = CONCURRENCY_LIMITS, queue_limits: dict = QUEUE_LIMITS):
+    self.limits = limits
+    self.queue_limits = queue_limits
+    self.admitted = {priority: 0 for priority in PRIORITIES}
+    self.running = {priority: 0 for priority in PRIORITIES}
+    self.waiting = {priority: 0 for priority in PRIORITIES}
+    self.condition = threading.Condition()
+
+  def outranked(self, priority: str):
+    """Whether any higher priority work is waiting or running. Must hold the condition"""
+    higher = PRIORITIES[:PRIORITIES.index(priority)]
+    return any(self.waiting[other] or self.running[other] for other in higher)
+
+  def can_run(self, priority: str):
+    return self.running[priority] < self.limits[priority] and not self.outranked(priority)
+
+  def admit(self, priority: str):
+    """Counts a new job of the class in, before it acquires the device for the first time
+
+    :raises QueueFullError: If the class already has as many jobs as its queue limit
+    """
+    with self.condition:
+      limit = self.queue_limits.get(priority)
+      if limit is not None and self.admitted[priority] >= limit:
+        raise QueueFullError('Too many {} jobs are queued, try again later'.format(priority))
+      self.admitted[priority] += 1
+
+  def leave(self, priority: str):
+    """Counts a job out once it is done with the device"""
+    with self.condition:
+      self.admitted[priority] -= 1
+
+  def acquire(self, priority: str):
+    start = time.perf_counter()
+    with self.condition:
+      self.waiting[priority] += 1
+      try:
+        self.condition.wait_for(lambda: self.can_run(priority))
+      finally:
+        self.waiting[priority] -= 1
+        # lower classes may have been waiting on this job
+        self.condition.notify_all()
+      self.running[priority] += 1
+    QUEUE_WAIT_SECONDS.labels(priority).observe(time.perf_counter() - start)
+
+  def release(self, priority: str):
+    with self.condition:
+      self.running[priority] -= 1
+      self.condition.notify_all()
+
+  def preempt(self, priority: str, hooks: tuple = ()):
+    """Yields the device to higher priority work if there is any, returning once the job may continue
+
+    :param hooks: Functions returning context managers the job is parked within, entered before the device is
+      yielded and exited once it is acquired again
+    :type hooks: tuple, optional
+    :return: Whether the job was preempted
+    """
+    with self.condition:
+      if not self.outranked(priority):
+        return False
+    PREEMPTIONS.labels(priority).inc()
+    logger.info('Preempting %s job for higher priority work', priority)
+    with ExitStack() as parked:
+      for hook in hooks:
+        parked.enter_context(hook())
+      self.release(priority)
+      self.acquire(priority)
+    return True
+
+arbiter = GpuArbiter()
+
+def validate_priority(priority: str):
+  if priority not in PRIORITIES:
+    raise ValueError('Unknown priority {}, expected one of {}'.format(priority, ', '.join(PRIORITIES)))
+
+@contextmanager
+def gpu_job(priority: str = DEFAULT_PRIORITY):
+  """Runs the wrapped device work as a job of the given priority class, waiting for the device first.
+  Nested jobs (e.g. upscaling within a generation) run as part of the outer job
+
+  :raises QueueFullError: If too many jobs of the class are already running or queued
+  """
+  validate_priority(priority)
+  if current_job.get() is not None:
+    yield
+    return
+  arbiter.admit(priority)
+  try:
+    arbiter.acquire(priority)
+    token = current_job.set(priority)
+    try:
+      yield
+    finally:
+      current_job.reset(token)
+      arbiter.release(priority)
+  finally:
+    arbiter.leave(priority)
+
+@contextmanager
+def no_preemption():
+  """Keeps the current job from being preempted within the block, e.g. while it holds a lock"""
+  token = preemption_suppressed.set(True)
+  try:
+    yield
+  finally:
+    preemption_suppressed.reset(token)
+
+@contextmanager
+def while_parked(hook):
+  """Parks the current job within the context manager hook() returns whenever it is preempted within the block,
+  e.g. to give back device memory it does not need while parked and take it again before resuming"""
+  token = parking_hooks.set(parking_hooks.get() + (hook,))
+  try:
+    yield
+  finally:
+    parking_hooks.reset(token)
+
+def preemption_point():
+  """Lets higher priority work take the device over from the current job, if any
+
+  :return: Whether the job was preempted
+  """
+  priority = current_job.get()
+  if priority is None or preemption_suppressed.get():
+    return False
+  return arbiter.preempt(priority, parking_hooks.get())
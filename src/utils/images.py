@@ -1,10 +1,86 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
 import cv2
 import numpy
 from PIL import Image
 
+from utils.metrics import IMAGE_CACHE, timed
+
+# Memory, in MB, that decoded input images are kept in before the least recently used are dropped
+IMAGE_CACHE_MB = int(os.getenv('IMAGE_CACHE_MB', '512'))
+
+image_cache = OrderedDict()
+image_cache_bytes = 0
+image_cache_lock = threading.Lock()
+
 def opencv2pil(cv_image):
   cv_image = cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB)
   return Image.fromarray(cv_image)
 
 def pil2opencv(pil_image: Image.Image):
   return cv2.cvtColor(numpy.array(pil_image), cv2.COLOR_RGB2BGR)
+
+def cached_decode(path: str, variant: tuple, decode):
+  """Decodes path with decode(path), unless the same variant of the same file version was decoded before
+
+  Entries are keyed by path, modification time and size, so an overwritten file is decoded again.
+  The returned array is shared between callers and read-only, copy it before modifying it in place.
+  """
+  stat = os.stat(path)
+  key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size) + variant
+  global image_cache_bytes
+  with image_cache_lock:
+    if key in image_cache:
+      image_cache.move_to_end(key)
+      IMAGE_CACHE.labels('hit').inc()
+      return image_cache[key]
+
+  IMAGE_CACHE.labels('miss').inc()
+  with timed('image_load'):
+    image = decode(path)
+  image.flags.writeable = False
+  with image_cache_lock:
+    if key not in image_cache:
+      image_cache[key] = image
+      image_cache_bytes += image.nbytes
+    while image_cache_bytes > IMAGE_CACHE_MB * 1024 * 1024 and len(image_cache) > 1:
+      _, evicted = image_cache.popitem(last=False)
+      image_cache_bytes -= evicted.nbytes
+  return image
+
+def load_cv_image(path: str):
+  """Read-only BGR image Mat of path, as cv2.imread(path, cv2.IMREAD_COLOR) but cached"""
+  def decode(path):
+    img = cv2.imread(path, cv2.IMREAD_COLOR)
+    if img is None:
+      raise ValueError('Could not decode image ' + path)
+    return img
+  return cached_decode(path, ('bgr',), decode)
+
+def load_rgb_array(path: str, short_edge: Optional[int] = None):
+  """Read-only RGB uint8 array of path, optionally resized so that its shorter edge is short_edge. Cached."""
+  def decode(path):
+    img = Image.open(path).convert("RGB")
+    width, height = img.size
+    if short_edge is not None and min(width, height) != short_edge:
+      if width < height:
+        img = img.resize((short_edge, int(short_edge * height / width)))
+      else:
+        img = img.resize((int(short_edge * width / height), short_edge))
+    return numpy.asarray(img)
+  return cached_decode(path, ('rgb', short_edge), decode)
+
+def load_pil_image(path: str, short_edge: Optional[int] = None):
+  """RGB PIL.Image of path, optionally resized so that its shorter edge is short_edge
+
+  Only the decoding is cached (see load_rgb_array), the image itself is a new copy of the pixels
+  """
+  return Image.fromarray(load_rgb_array(path, short_edge))
+
+def image_size(path: str):
+  """(width, height) of the image at path, only reading the header"""
+  with Image.open(path) as img:
+    return img.size
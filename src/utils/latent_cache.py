@@ -0,0 +1,58 @@
+import os
+import uuid
+
+import torch
+
+from utils.file_utils import CACHE_DIR
+
+# Directory holding one checkpoint file per generation
+LATENT_CACHE_DIR = os.path.join(CACHE_DIR, 'latents')
+# Maximum number of generations to keep checkpoints for, least recently used are evicted first
+LATENT_CACHE_SIZE = int(os.getenv('LATENT_CACHE_SIZE', '32'))
+# Intermediate latents are saved every this many denoising steps (the final latents are always saved)
+LATENT_CHECKPOINT_INTERVAL = int(os.getenv('LATENT_CHECKPOINT_INTERVAL', '5'))
+
+def new_checkpoint_id():
+  return uuid.uuid4().hex
+
+def checkpoint_path(checkpoint_id: str):
+  # ids are generated by new_checkpoint_id, refuse anything that could escape the cache dir
+  if not checkpoint_id.isalnum():
+    raise ValueError('Invalid checkpoint id ' + checkpoint_id)
+  return os.path.join(LATENT_CACHE_DIR, checkpoint_id + '.pt')
+
+def prune_checkpoints(keep: int = LATENT_CACHE_SIZE):
+  """Removes the least recently used checkpoints until at most `keep` remain"""
+  if not os.path.isdir(LATENT_CACHE_DIR):
+    return
+  paths = [os.path.join(LATENT_CACHE_DIR, name) for name in os.listdir(LATENT_CACHE_DIR) if name.endswith('.pt')]
+  paths.sort(key=os.path.getmtime, reverse=True)
+  for path in paths[keep:]:
+    os.remove(path)
+
+def save_checkpoint(checkpoint_id: str, checkpoint: dict):
+  """Persists a generation checkpoint, evicting old ones to keep the cache bounded
+
+  :param checkpoint_id: Id returned from new_checkpoint_id
+  :type checkpoint_id: str
+  :param checkpoint: dict of generation parameters ("meta") and saved latents per step ("steps")
+  :type checkpoint: dict
+  """
+  os.makedirs(LATENT_CACHE_DIR, exist_ok=True)
+  torch.save(checkpoint, checkpoint_path(checkpoint_id))
+  prune_checkpoints()
+
+def load_checkpoint(checkpoint_id: str, device=None):
+  """Loads a generation checkpoint, marking it as recently used
+
+  :param checkpoint_id: Id the checkpoint was saved under
+  :type checkpoint_id: str
+  :param device: Device to map the saved tensors onto
+  :return: The checkpoint dict as given to save_checkpoint
+  :rtype: dict
+  :raises FileNotFoundError: If the checkpoint was never saved or has been evicted
+  """
+  path = checkpoint_path(checkpoint_id)
+  checkpoint = torch.load(path, map_location=device)
+  os.utime(path)
+  return checkpoint
@@ -0,0 +1,247 @@
+import os
+import threading
+import types
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+
+import torch
+
+from utils.gpu_queue import while_parked
+
+# If set, the number of MB of device memory generations may use, instead of what the device reports as free
+MEMORY_BUDGET_MB = os.getenv('MEMORY_BUDGET_MB')
+# Fraction of the budget kept back for allocator fragmentation and the estimates below being rough
+MEMORY_HEADROOM = float(os.getenv('MEMORY_HEADROOM', '0.1'))
+
+# Rough peak memory model of Stable Diffusion v1, meant to pick the right memory savings rather than to be exact.
+# The UNet self-attention at 1/8 resolution holds a (queries x tokens) score matrix, plus its softmax,
+# for every attention head of every image in the batch
+UNET_ATTENTION_HEADS = 8
+ATTENTION_COPIES = 2
+# Everything else in the UNet grows linearly with the number of latent tokens
+UNET_BYTES_PER_TOKEN_PER_IMAGE = 320 * 40
+# The VAE decoder works on 64 pixels per latent token with 128-512 channels, and has a single head
+# self-attention at 1/8 resolution
+VAE_BYTES_PER_PIXEL = 128 * 6
+VAE_ATTENTION_HEADS = 1
+
+# Plans to try, from fastest to most memory efficient. Attention is either computed all at once,
+# sliced by half of the heads at a time, or chunked by this many query tokens at a time
+ATTENTION_PLANS = [
+  {"attention_slice": None, "attention_chunk": None},
+  {"attention_slice": "auto", "attention_chunk": None},
+  {"attention_slice": None, "attention_chunk": 1024},
+  {"attention_slice": None, "attention_chunk": 256},
+]
+
+# Attention savings of the generation running in the current context, see planned_attention
+attention_plan: ContextVar = ContextVar('attention_plan', default=ATTENTION_PLANS[0])
+
+# Estimates of the generations currently running, and the memory available when none was (see reserve_memory)
+reserved_bytes = 0
+idle_budget = None
+reservation_lock = threading.Lock()
+reservation_released = threading.Condition(reservation_lock)
+
+class InsufficientMemoryError(Exception):
+  """Raised when a generation cannot fit in device memory, whatever memory savings are used"""
+  pass
+
+def element_size(dtype: torch.dtype):
+  return torch.tensor([], dtype=dtype).element_size()
+
+def available_memory():
+  """Bytes of device memory available to a generation: the free device memory plus what torch has cached but not allocated"""
+  if MEMORY_BUDGET_MB is not None:
+    return int(MEMORY_BUDGET_MB) * 1024 * 1024
+  if not torch.cuda.is_available():
+    return None
+  free, _ = torch.cuda.mem_get_info()
+  return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+
+def estimate_memory(
+  width: int,
+  height: int,
+  batch_size: int = 1,
+  dtype: torch.dtype = torch.float16,
+  guidance: bool = True,
+  attention_slice: Optional[str] = None,
+  attention_chunk: Optional[int] = None,
+  vae_tile: Optional[int] = None,
+):
+  """Estimates peak activation memory of a Stable Diffusion generation, excluding the model weights
+
+  :param width: Width of the output image in pixels
+  :type width: int
+  :param height: Height of the output image in pixels
+  :type height: int
+  :param batch_size: Number of images generated at once
+  :type batch_size: int, optional
+  :param dtype: Precision the model runs in
+  :type dtype: torch.dtype, optional
+  :param guidance: Whether classifier free guidance doubles the UNet batch
+  :type guidance: bool, optional
+  :param attention_slice: "auto" if attention is computed for half of the heads at a time
+  :type attention_slice: Optional[str], optional
+  :param attention_chunk: Number of query tokens attention is computed for at a time, all of them if not defined
+  :type attention_chunk: Optional[int], optional
+  :param vae_tile: Tile size in latents if decoding tile by tile, otherwise the whole image is decoded at once
+  :type vae_tile: Optional[int], optional
+  :return: Estimated peak in bytes
+  :rtype: int
+  """
+  bytes_per_element = element_size(dtype)
+  tokens = (width // 8) * (height // 8)
+  unet_batch = batch_size * (2 if guidance else 1)
+
+  heads_at_once = unet_batch * UNET_ATTENTION_HEADS
+  if attention_slice == 'auto':
+    heads_at_once = heads_at_once // 2
+  queries_at_once = tokens if attention_chunk is None else min(tokens, attention_chunk)
+  unet_attention = heads_at_once * queries_at_once * tokens * bytes_per_element * ATTENTION_COPIES
+  unet = unet_attention + unet_batch * tokens * UNET_BYTES_PER_TOKEN_PER_IMAGE * bytes_per_element
+
+  vae_tokens = tokens if vae_tile is None else min(tokens, vae_tile * vae_tile)
+  vae_attention = VAE_ATTENTION_HEADS * vae_tokens * vae_tokens * bytes_per_element * ATTENTION_COPIES
+  vae = vae_attention + vae_tokens * 64 * VAE_BYTES_PER_PIXEL * bytes_per_element
+  if vae_tile is not None:
+    # the blended full resolution output is accumulated in single precision
+    vae += width * height * 4 * 4
+
+  # the UNet activations are freed before decoding
+  return max(unet, vae)
+
+def plan_memory(
+  width: int,
+  height: int,
+  batch_size: int = 1,
+  dtype: torch.dtype = torch.float16,
+  guidance: bool = True,
+  vae_tile: int = 64,
+  budget: Optional[int] = None,
+):
+  """Picks the fastest memory savings that let a generation fit in the available device memory
+
+  :param budget: Bytes of device memory the generation may use, measured with available_memory if not defined
+  :type budget: Optional[int], optional
+  :return: dict of "attention_slice", "attention_chunk" (see estimate_memory), "vae_tiling" (bool) and "estimate" (bytes)
+  :rtype: dict
+  :raises InsufficientMemoryError: If even the most memory efficient plan does not fit
+  """
+  options = []
+  for vae_tile_size in [None, vae_tile]:
+    for attention in ATTENTION_PLANS:
+      options.append({
+        **attention,
+        "vae_tiling": vae_tile_size is not None,
+        "estimate": estimate_memory(width, height, batch_size, dtype, guidance, vae_tile=vae_tile_size, **attention),
+      })
+
+  if budget is None:
+    budget = available_memory()
+  if budget is None:
+    # no device to measure, e.g. running on CPU, so run without any savings
+    return options[0]
+  usable = budget * (1 - MEMORY_HEADROOM)
+  for option in options:
+    if option["estimate"] <= usable:
+      return option
+  raise InsufficientMemoryError(
+    "A {}x{} generation needs an estimated {:.1f}GB of device memory even with chunked attention and tiled decoding, "
+    "but only {:.1f}GB is available".format(
+      width, height, options[-1]["estimate"] / 2 ** 30, usable / 2 ** 30))
+
+def planned_attention_forward(self, hidden_states, context=None, mask=None):
+  """Replacement for diffusers' CrossAttention.forward following the attention plan of the current generation
+  (see planned_attention), computing attention for a slice of the heads and a chunk of the queries at a time"""
+  plan = attention_plan.get()
+  query = self.reshape_heads_to_batch_dim(self.to_q(hidden_states))
+  context = context if context is not None else hidden_states
+  key = self.reshape_heads_to_batch_dim(self.to_k(context)).transpose(1, 2)
+  value = self.reshape_heads_to_batch_dim(self.to_v(context))
+
+  heads, queries = query.shape[0], query.shape[1]
+  slice_size = heads if plan["attention_slice"] is None else max(1, heads // 2)
+  chunk_size = queries if plan["attention_chunk"] is None else plan["attention_chunk"]
+  hidden_states = torch.empty((heads, queries, value.shape[2]), device=query.device, dtype=query.dtype)
+  for head in range(0, heads, slice_size):
+    heads_slice = slice(head, head + slice_size)
+    for start in range(0, queries, chunk_size):
+      queries_chunk = slice(start, start + chunk_size)
+      attention = (torch.matmul(query[heads_slice, queries_chunk], key[heads_slice]) * self.scale).softmax(dim=-1)
+      hidden_states[heads_slice, queries_chunk] = torch.matmul(attention, value[heads_slice])
+  return self.to_out(self.reshape_batch_dim_to_heads(hidden_states))
+
+def use_planned_attention(unet):
+  """Makes every attention layer of the unet follow the attention plan of the generation it is running for"""
+  for module in unet.modules():
+    if type(module).__name__ == 'CrossAttention':
+      module.forward = types.MethodType(planned_attention_forward, module)
+
+@contextmanager
+def planned_attention(plan: dict):
+  """Runs the attention layers set up by use_planned_attention with the plan's attention savings within the block.
+  The plan only applies to the current context, so concurrent generations each follow their own"""
+  token = attention_plan.set({key: plan[key] for key in ["attention_slice", "attention_chunk"]})
+  try:
+    yield
+  finally:
+    attention_plan.reset(token)
+
+def remaining_budget():
+  """Bytes of the idle budget not reserved by running generations, None without a device. Must hold reservation_lock"""
+  return None if idle_budget is None else idle_budget - reserved_bytes
+
+@contextmanager
+def reserve_memory(width: int, height: int, guidance: bool = True, **kwargs):
+  """Plans a generation (see plan_memory) in the memory left by the generations already running, and reserves
+  its estimate until the block exits. If no plan fits beside them, waits for them to release their reservations.
+
+  Free device memory is only measured while no generation is running: what running generations have allocated
+  is accounted for by their reservations instead, so that it is not counted twice.
+  The reservation is given back while the generation is parked by preemption (see gpu_queue.while_parked)
+
+  :raises InsufficientMemoryError: If the generation does not fit in device memory even with no other generation running
+  """
+  global idle_budget, reserved_bytes
+  with reservation_released:
+    while True:
+      if reserved_bytes == 0:
+        idle_budget = available_memory()
+      try:
+        plan = plan_memory(width, height, guidance=guidance, budget=remaining_budget(), **kwargs)
+        break
+      except InsufficientMemoryError:
+        # running generations will give their memory back, but waiting would never help one that needs more than all of it
+        if reserved_bytes == 0:
+          raise
+        plan_memory(width, height, guidance=guidance, budget=idle_budget, **kwargs)
+        reservation_released.wait()
+    reserved_bytes += plan["estimate"]
+  try:
+    with while_parked(lambda: parked_reservation(plan["estimate"])):
+      yield plan
+  finally:
+    release_reservation(plan["estimate"])
+
+def release_reservation(estimate: int):
+  global reserved_bytes
+  with reservation_released:
+    reserved_bytes -= estimate
+    reservation_released.notify_all()
+
+@contextmanager
+def parked_reservation(estimate: int):
+  """Gives a reservation back while its generation is parked, taking it again once there is room for it"""
+  global idle_budget, reserved_bytes
+  release_reservation(estimate)
+  try:
+    yield
+  finally:
+    with reservation_released:
+      while reserved_bytes > 0 and idle_budget is not None and estimate > remaining_budget() * (1 - MEMORY_HEADROOM):
+        reservation_released.wait()
+      if reserved_bytes == 0:
+        idle_budget = available_memory()
+      reserved_bytes += estimate
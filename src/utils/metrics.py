@@ -0,0 +1,84 @@
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram
+
+logger = logging.getLogger('painter')
+
+STAGE_SECONDS = Histogram(
+  'painter_stage_seconds',
+  'Time spent in each stage of handling a request',
+  ['stage'],
+  buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+MODEL_CACHE = Counter(
+  'painter_model_cache_total',
+  'Lookups of loaded models, by whether the model had already been loaded',
+  ['model', 'result'])
+IMAGE_CACHE = Counter(
+  'painter_image_cache_total',
+  'Lookups of decoded input images, by whether the image was already decoded',
+  ['result'])
+QUEUE_DEPTH = Gauge(
+  'painter_queue_depth',
+  'Transform requests currently waiting or running',
+  ['transform'])
+QUEUE_WAIT_SECONDS = Histogram(
+  'painter_queue_wait_seconds',
+  'Time jobs spent waiting for the device, including after being preempted, by priority class',
+  ['priority'],
+  buckets=(0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600))
+PREEMPTIONS = Counter(
+  'painter_preemptions_total',
+  'Jobs that gave the device up to higher priority work, by priority class',
+  ['priority'])
+COALESCED = Counter(
+  'painter_coalesced_requests_total',
+  'Transform requests answered with the result of an identical request already in progress',
+  ['transform'])
+COALESCED_SECONDS = Counter(
+  'painter_coalesced_seconds_total',
+  'Computation time saved by coalescing identical transform requests',
+  ['transform'])
+DEVICE_MEMORY = Gauge(
+  'painter_device_memory_bytes',
+  'Device memory held by torch',
+  ['kind'])
+
+DEVICE_MEMORY.labels('allocated').set_function(
+  lambda: torch.cuda.memory_allocated() if torch.cuda.is_available() else 0)
+DEVICE_MEMORY.labels('reserved').set_function(
+  lambda: torch.cuda.memory_reserved() if torch.cuda.is_available() else 0)
+DEVICE_MEMORY.labels('max_allocated').set_function(
+  lambda: torch.cuda.max_memory_allocated() if torch.cuda.is_available() else 0)
+
+# Seconds spent per stage while handling the current request, logged once the request is done
+request_timings: ContextVar = ContextVar('request_timings', default=None)
+
+@contextmanager
+def timed(stage: str):
+  """Times a stage, both into the stage histogram and the current request's timings.
+  Also usable as a function decorator"""
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    elapsed = time.perf_counter() - start
+    STAGE_SECONDS.labels(stage).observe(elapsed)
+    timings = request_timings.get()
+    if timings is not None:
+      timings[stage] = timings.get(stage, 0.0) + elapsed
+
+@contextmanager
+def in_flight(transform: str):
+  """Counts a transform request towards the queue depth while it is waiting or running"""
+  QUEUE_DEPTH.labels(transform).inc()
+  try:
+    yield
+  finally:
+    QUEUE_DEPTH.labels(transform).dec()
+
+def record_model_cache(model: str, hit: bool):
+  MODEL_CACHE.labels(model, 'hit' if hit else 'miss').inc()
@@ -0,0 +1,145 @@
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import torch
+
+from utils.file_utils import CACHE_DIR
+from utils.metrics import logger
+
+PROFILE_DIR = os.path.join(CACHE_DIR, 'profiles')
+# Profile one in every this many requests even when not asked to, 0 to only profile on request
+PROFILE_SAMPLE_EVERY = int(os.getenv('PROFILE_SAMPLE_EVERY', '0'))
+# Seconds between two samples of the Python stack
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+# Number of trace files kept, oldest are removed first
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+
+# Id of the profile to record the current request under, None if the request is not profiled
+profile_request: ContextVar = ContextVar('profile_request', default=None)
+# List the names of the profiles saved for the current request are appended to, so that they reach the code
+# that set it up even from other contexts (e.g. the threadpool sync endpoints run in)
+saved_profiles: ContextVar = ContextVar('saved_profiles', default=None)
+
+request_counter = itertools.count(1)
+# Held while a profile is recorded: the torch profiler is process wide, so only one session may be active at a time
+profiler_lock = threading.Lock()
+
+def should_profile(requested: bool):
+  """Whether to profile a request, either because it asked to be or because it is sampled"""
+  sampled = PROFILE_SAMPLE_EVERY > 0 and next(request_counter) % PROFILE_SAMPLE_EVERY == 0
+  return requested or sampled
+
+def new_profile_id():
+  return time.strftime('%Y%m%d-%H%M%S') + '-' + os.urandom(3).hex()
+
+def list_profiles():
+  if not os.path.isdir(PROFILE_DIR):
+    return []
+  profiles = []
+  for name in os.listdir(PROFILE_DIR):
+    path = os.path.join(PROFILE_DIR, name)
+    profiles.append({"name": name, "size": os.path.getsize(path), "time": os.path.getmtime(path)})
+  profiles.sort(key=lambda profile: -profile["time"])
+  return profiles
+
+def prune_profiles(keep: int = PROFILE_KEEP):
+  for profile in list_profiles()[keep:]:
+    os.remove(os.path.join(PROFILE_DIR, profile["name"]))
+
+class StackSampler(threading.Thread):
+  """Samples the Python stack of another thread at a fixed interval, and renders the samples as Chrome trace events"""
+
+  def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+    super().__init__(daemon=True)
+    self.thread_id = thread_id
+    self.interval = interval
+    self.samples = []
+    self.stopped = threading.Event()
+
+  def run(self):
+    while not self.stopped.wait(self.interval):
+      frame = sys._current_frames().get(self.thread_id)
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append('{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+        frame = frame.f_back
+      self.samples.append((time.perf_counter(), stack[::-1]))
+
+  def stop(self):
+    self.stopped.set()
+    self.join()
+
+  def trace_events(self):
+    """Merges consecutive samples sharing the same frames into one complete ("X") event per frame"""
+    events = []
+    open_frames = []
+
+    def close_frames(depth: int, end: float):
+      while len(open_frames) > depth:
+        name, start = open_frames.pop()
+        events.append({
+          "name": name,
+          "ph": "X",
+          "ts": start * 1e6,
+          "dur": (end - start) * 1e6,
+          "pid": "python",
+          "tid": self.thread_id,
+        })
+
+    for timestamp, stack in self.samples:
+      common = 0
+      while common < min(len(stack), len(open_frames)) and open_frames[common][0] == stack[common]:
+        common += 1
+      close_frames(common, timestamp)
+      open_frames.extend((name, timestamp) for name in stack[common:])
+    if self.samples:
+      close_frames(0, self.samples[-1][0] + self.interval)
+    return events
+
+@contextmanager
+def profiled(name: str):
+  """Profiles the wrapped inference with the torch profiler and a Python stack sampler if the current request
+  is profiled, saving both as Chrome traces (open in chrome://tracing or https://ui.perfetto.dev).
+
+  Only one inference is profiled at a time, others run unprofiled. The torch trace still shows the kernels of
+  whatever else runs on the device meanwhile
+  """
+  profile_id = profile_request.get()
+  if profile_id is None:
+    yield
+    return
+  if not profiler_lock.acquire(blocking=False):
+    logger.info('Not profiling %s of request %s, another profile is being recorded', name, profile_id)
+    yield
+    return
+
+  try:
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+      activities.append(torch.profiler.ProfilerActivity.CUDA)
+    sampler = StackSampler(threading.get_ident())
+    with torch.profiler.profile(activities=activities) as torch_profile:
+      sampler.start()
+      try:
+        yield
+      finally:
+        sampler.stop()
+
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prefix = os.path.join(PROFILE_DIR, '{}_{}'.format(profile_id, name))
+    torch_profile.export_chrome_trace(prefix + '_torch.json')
+    with open(prefix + '_python.json', 'w') as trace:
+      json.dump({"traceEvents": sampler.trace_events()}, trace)
+  finally:
+    profiler_lock.release()
+  if saved_profiles.get() is not None:
+    saved_profiles.get().append(name)
+  logger.info('Saved profile of %s to %s_{torch,python}.json', name, prefix)
+  prune_profiles()
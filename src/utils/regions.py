@@ -0,0 +1,53 @@
+# Region-limited inpainting: only the part of the image around the mask is diffused, at the model's
+# native resolution, and pasted back into the full image
+
+import os
+
+from PIL import Image, ImageFilter
+
+# Resolution, in pixels along the longer side, that inpainting windows are diffused at
+INPAINT_REGION_SIZE = int(os.getenv('INPAINT_REGION_SIZE', '512'))
+# Pixels of context kept around the mask's bounding box, so the model sees what it is blending into
+INPAINT_REGION_PADDING = int(os.getenv('INPAINT_REGION_PADDING', '64'))
+# Radius, in pixels of the full image, of the blur feathering the mask edges when pasting the region back
+INPAINT_FEATHER_RADIUS = int(os.getenv('INPAINT_FEATHER_RADIUS', '8'))
+
+def fit_mask(mask: Image.Image, size: tuple):
+  """Grayscale mask at size, the size of the image it applies to"""
+  mask = mask.convert('L')
+  if mask.size != size:
+    mask = mask.resize(size, resample=Image.NEAREST)
+  return mask
+
+def region_window(mask: Image.Image, padding: int = INPAINT_REGION_PADDING):
+  """(left, upper, right, lower) box around the mask's painted pixels plus padding, clamped to the mask
+
+  :raises ValueError: If the mask is empty, so there is nothing to inpaint
+  """
+  bbox = mask.getbbox()
+  if bbox is None:
+    raise ValueError('The mask is empty, there is nothing to inpaint')
+  left, upper, right, lower = bbox
+  width, height = mask.size
+  return (max(left - padding, 0), max(upper - padding, 0), min(right + padding, width), min(lower + padding, height))
+
+def region_size(window: tuple, native: int = INPAINT_REGION_SIZE):
+  """Size the window is diffused at: its longer side scaled to native, both sides multiples of 64 for the UNet"""
+  width, height = window[2] - window[0], window[3] - window[1]
+  scale = native / max(width, height)
+  return tuple(max(64, int(round(side * scale / 64)) * 64) for side in (width, height))
+
+def crop_region(image: Image.Image, mask: Image.Image, window: tuple):
+  """Crops of the image and mask to the window, resized to the resolution they are diffused at"""
+  size = region_size(window)
+  return image.crop(window).resize(size, resample=Image.LANCZOS), mask.crop(window).resize(size, resample=Image.NEAREST)
+
+def paste_region(image: Image.Image, mask: Image.Image, region: Image.Image, window: tuple, feather: int = INPAINT_FEATHER_RADIUS):
+  """Pastes the inpainted region back over the window of image, through the mask with feathered edges"""
+  size = (window[2] - window[0], window[3] - window[1])
+  alpha = mask.crop(window)
+  if feather > 0:
+    alpha = alpha.filter(ImageFilter.GaussianBlur(feather))
+  result = image.convert('RGB')
+  result.paste(region.resize(size, resample=Image.LANCZOS), window[:2], alpha)
+  return result
@@ -0,0 +1,35 @@
+from diffusers import DDIMScheduler, LMSDiscreteScheduler, PNDMScheduler
+
+from utils.denoise import fresh_scheduler
+
+# Noise schedule Stable Diffusion v1 was trained with, every sampler has to follow it
+STABLE_DIFFUSION_BETAS = {
+  "beta_start": 0.00085,
+  "beta_end": 0.012,
+  "beta_schedule": "scaled_linear",
+}
+
+# Uses whatever scheduler the model ships with (PNDM for stable-diffusion-v1-4)
+DEFAULT_SCHEDULER = 'default'
+
+SCHEDULERS = {
+  'pndm': lambda: PNDMScheduler(skip_prk_steps=True, **STABLE_DIFFUSION_BETAS),
+  'ddim': lambda: DDIMScheduler(clip_sample=False, set_alpha_to_one=False, **STABLE_DIFFUSION_BETAS),
+  'lms': lambda: LMSDiscreteScheduler(**STABLE_DIFFUSION_BETAS),
+}
+
+SCHEDULER_NAMES = [DEFAULT_SCHEDULER] + list(SCHEDULERS.keys())
+
+def get_scheduler(pipe, name: str = DEFAULT_SCHEDULER):
+  """Builds a new scheduler for a single generation
+
+  :param pipe: Stable Diffusion pipeline, whose scheduler is copied for the default
+  :param name: One of SCHEDULER_NAMES
+  :type name: str
+  :raises ValueError: If the scheduler is unknown
+  """
+  if name == DEFAULT_SCHEDULER:
+    return fresh_scheduler(pipe)
+  if name not in SCHEDULERS:
+    raise ValueError('Unknown scheduler {}, expected one of {}'.format(name, ', '.join(SCHEDULER_NAMES)))
+  return SCHEDULERS[name]()
@@ -0,0 +1,65 @@
+import os
+import threading
+import time
+
+from utils.metrics import COALESCED, COALESCED_SECONDS, logger
+
+class Flight:
+  """A computation in progress, which identical requests wait on instead of recomputing"""
+
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+    self.seconds = 0.0
+
+flights = {}
+flights_lock = threading.Lock()
+
+def file_identity(path: str):
+  """(path, modification time, size) of a file, so that an overwritten input is never coalesced with the old one"""
+  try:
+    stat = os.stat(path)
+  except OSError:
+    return (path, None, None)
+  return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+def flight_key(transform: str, input_image: str, **params):
+  """Canonical key of a transform call: the transform, the identity of its input file and its sorted parameters.
+  Numbers are compared by value, so that scale=2 and scale=2.0 are the same request"""
+  canonical = tuple(sorted(
+    (name, float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value)
+    for name, value in params.items()
+  ))
+  return (transform, file_identity(input_image), canonical)
+
+def single_flight(transform: str, key, compute):
+  """Returns compute(), unless an identical call (same key) is already running, in which case its result is
+  awaited and returned instead. Errors are shared the same way as results"""
+  with flights_lock:
+    flight = flights.get(key)
+    leader = flight is None
+    if leader:
+      flight = flights[key] = Flight()
+
+  if not leader:
+    flight.done.wait()
+    COALESCED.labels(transform).inc()
+    COALESCED_SECONDS.labels(transform).inc(flight.seconds)
+    logger.info('Coalesced %s request with the identical one in progress', transform)
+    if flight.error is not None:
+      raise flight.error
+    return flight.result
+
+  start = time.perf_counter()
+  try:
+    flight.result = compute()
+    return flight.result
+  except Exception as error:
+    flight.error = error
+    raise
+  finally:
+    flight.seconds = time.perf_counter() - start
+    with flights_lock:
+      del flights[key]
+    flight.done.set()
@@ -0,0 +1,33 @@
+import os
+from fastapi import FastAPI
+from fastapi.staticfiles import StaticFiles
+
+from transforms import gfpgan, real_ersgan,stable_diffusion
+from utils.db import init_db
+from utils.file_utils import UPLOAD_DIR, OUTPUT_DIR, ROOT_DIR
+from web import file_mgmt, history, metrics, profiles
+
+API_PATH = "/api"
+
+REACT_FRONTEND_BUILD_DIR = os.path.join(ROOT_DIR, "src/web/frontend/build")
+
+def create_app(serve_files: bool = True):
+  """Builds the app, serving the API and, if serve_files, the images and the React frontend"""
+  app = FastAPI()
+  app.middleware("http")(metrics.timing_middleware)
+  app.middleware("http")(profiles.profiling_middleware)
+
+  init_db()
+  app.include_router(gfpgan.router, prefix= API_PATH)
+  app.include_router(real_ersgan.router, prefix= API_PATH)
+  app.include_router(stable_diffusion.router, prefix= API_PATH)
+  app.include_router(file_mgmt.router, prefix= API_PATH)
+  app.include_router(history.router, prefix= API_PATH)
+  app.include_router(profiles.router, prefix= API_PATH)
+  app.include_router(metrics.router)
+
+  if serve_files:
+    app.mount('/uploads', StaticFiles(directory=UPLOAD_DIR))
+    app.mount('/output', StaticFiles(directory=OUTPUT_DIR))
+    app.mount("/", StaticFiles(directory=REACT_FRONTEND_BUILD_DIR, html=True))
+  return app
@@ -6,6 +6,7 @@ from pathlib import Path
 from fastapi import APIRouter, FastAPI, File, UploadFile
 from utils.db import get_images, delete_image, add_image_file
 from utils.file_utils import ROOT_DIR, OUTPUT_DIR, UPLOAD_DIR, get_png_filename, trim_path
+from utils.metrics import logger, timed
 
 router = APIRouter()
 
@@ -30,13 +31,12 @@ def list_files():
 
 @router.post("/files/upload")
 def upload_file(file: UploadFile):
-  print("Got file", file)
   basename = Path(file.filename).stem
   upload_dest = get_png_filename(basename, UPLOAD_DIR)
   ret = None
   try:
-    with open(upload_dest, "wb") as buffer:
-      print("Saving image", upload_dest)
+    with timed('encode_save'), open(upload_dest, "wb") as buffer:
+      logger.info("Saving upload %s to %s", file.filename, upload_dest)
       shutil.copyfileobj(file.file, buffer)
     ret = add_image_file(upload_dest, "Uploaded Image")
   finally:
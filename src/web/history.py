@@ -0,0 +1,13 @@
+from fastapi import APIRouter
+
+from utils.db import autocomplete_prompts, search_prompts
+
+router = APIRouter()
+
+@router.get("/history/autocomplete")
+def autocomplete(prefix: str = "", limit: int = 10):
+  return autocomplete_prompts(prefix, limit)
+
+@router.get("/history/search")
+def search(q: str, limit: int = 20):
+  return search_prompts(q, limit)
@@ -0,0 +1,33 @@
+import json
+import time
+
+from fastapi import APIRouter, Request, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+from utils.metrics import logger, request_timings
+
+router = APIRouter()
+
+@router.get("/metrics")
+def metrics():
+  return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def timing_middleware(request: Request, call_next):
+  """Logs one structured line per request, with the time spent in every stage timed while handling it"""
+  timings = {}
+  request_timings.set(timings)
+  start = time.perf_counter()
+  status = 500
+  try:
+    response = await call_next(request)
+    status = response.status_code
+    return response
+  finally:
+    if request.url.path != "/metrics":
+      logger.info(json.dumps({
+        "method": request.method,
+        "path": request.url.path,
+        "status": status,
+        "seconds": round(time.perf_counter() - start, 4),
+        "stages": {stage: round(seconds, 4) for stage, seconds in timings.items()},
+      }))
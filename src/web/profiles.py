@@ -0,0 +1,43 @@
+import os
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse
+
+from utils.profiling import PROFILE_DIR, list_profiles, new_profile_id, profile_request, saved_profiles, should_profile
+
+router = APIRouter()
+
+PROFILE_HEADER = "X-Profile"
+TRUTHY = ["1", "true", "yes"]
+# Requests to the endpoints which run profiled inference, the only ones counted towards sampling
+PROFILED_PATH_PREFIX = "/api/transforms/"
+
+async def profiling_middleware(request: Request, call_next):
+  """Profiles transform requests sent with an X-Profile header or profile query parameter, and a sample of the others.
+  The profile id is returned in the X-Profile-Id response header when a profile was saved, which it is not when
+  another request was being profiled at the same time"""
+  if not request.url.path.startswith(PROFILED_PATH_PREFIX):
+    return await call_next(request)
+  requested = (
+    request.headers.get(PROFILE_HEADER, "").lower() in TRUTHY
+    or request.query_params.get("profile", "").lower() in TRUTHY)
+  profile_id, saved = None, []
+  if should_profile(requested):
+    profile_id = new_profile_id()
+    profile_request.set(profile_id)
+    saved_profiles.set(saved)
+  response = await call_next(request)
+  if saved:
+    response.headers["X-Profile-Id"] = profile_id
+  return response
+
+@router.get("/profiles")
+def get_profiles():
+  return list_profiles()
+
+@router.get("/profiles/{name}")
+def download_profile(name: str):
+  path = os.path.join(PROFILE_DIR, name)
+  if os.path.dirname(os.path.abspath(path)) != os.path.abspath(PROFILE_DIR) or not os.path.isfile(path):
+    raise HTTPException(status_code=404, detail="Unknown profile " + name)
+  return FileResponse(path, media_type="application/json", filename=name)